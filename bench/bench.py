@@ -0,0 +1,298 @@
+"""Build benchmark over synthetic websites"""
+
+import argparse
+import base64
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import sssg  # noqa: E402
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+words = (
+    "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod "
+    "tempor incididunt ut labore et dolore magna aliqua enim ad minim veniam "
+    "quis nostrud exercitation ullamco laboris nisi aliquip ex ea commodo "
+    "consequat duis aute irure in reprehenderit voluptate velit esse cillum "
+    "fugiat nulla pariatur excepteur sint occaecat cupidatat non proident"
+).split()
+
+
+def parse_arguments():
+    """Parse and return command line arguments"""
+    parser = argparse.ArgumentParser(
+        prog="bench", description="Benchmark sssg builds over synthetic websites"
+    )
+    parser.add_argument("--posts", type=int, default=200, help="markdown posts")
+    parser.add_argument("--paragraphs", type=int, default=8, help="paragraphs per post")
+    parser.add_argument("--templates", type=int, default=3, help="depth of nested templates")
+    parser.add_argument("--loops", type=int, default=5, help="pages looping over all posts")
+    parser.add_argument("--notebooks", type=int, default=10, help="notebook posts")
+    parser.add_argument("--images", type=int, default=2, help="image outputs per notebook")
+    parser.add_argument("--public", type=int, default=100, help="files in public")
+    parser.add_argument("--public-size", type=int, default=20000, help="bytes per public file")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the generated website")
+    parser.add_argument("--jobs", type=int, default=1, help="jobs passed to the build")
+    parser.add_argument("--cache", action="store_true", help="use a build cache kept between repeats")
+    parser.add_argument("--repeat", type=int, default=3, help="builds to run")
+    parser.add_argument("--site", help="keep the generated website in this directory")
+    parser.add_argument("--output", help="write the JSON report to this file")
+    parser.add_argument("--run-once", nargs=3, metavar=("SITE", "OUT", "CACHE"), help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def sentence(rng, length):
+    """Returns `length` random words"""
+    return " ".join(rng.choice(words) for _ in range(length))
+
+
+def write(path, contents):
+    """Write a text or bytes file, creating its directory"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if isinstance(contents, bytes):
+        with open(path, "wb") as f:
+            f.write(contents)
+    else:
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(contents)
+
+
+def png_bytes(rng, width, height):
+    """Returns a PNG of random blocks, compressible like a real plot"""
+    pic = Image.new("RGB", (width, height), "white")
+    for _ in range(20):
+        x, y = rng.randrange(width), rng.randrange(height)
+        color = (rng.randrange(256), rng.randrange(256), rng.randrange(256))
+        pic.paste(color, (x, y, min(width, x + 40), min(height, y + 30)))
+    out = io.BytesIO()
+    pic.save(out, format="PNG")
+    return out.getvalue()
+
+
+def generate_site(site_dir, args):
+    """Write a synthetic input directory"""
+    rng = random.Random(args.seed)
+    write(os.path.join(site_dir, "config.yml"), 'title: "Benchmark"\nauthor: "sssg"\n')
+
+    # templates
+    templates = os.path.join(site_dir, "templates")
+    write(os.path.join(templates, "head.html"), "<head><title>{% global title %}</title></head>\n")
+    write(os.path.join(templates, "footer.html"), "<footer>{% global author %}</footer>\n")
+    write(
+        os.path.join(templates, "base.html"),
+        "<!DOCTYPE html>\n<html>\n{% expand head.html %}\n<body>\n{% content %}\n"
+        "{% expand footer.html %}\n</body>\n</html>\n",
+    )
+    parent = "base.html"
+    for i in range(args.templates):
+        name = f"layer{i}.html"
+        write(
+            os.path.join(templates, name),
+            f"{{% template {parent} %}}\n<div class=\"layer{i}\">\n{{% content %}}\n</div>\n",
+        )
+        parent = name
+    write(
+        os.path.join(templates, "post.html"),
+        f"{{% template {parent} %}}\n<h1>{{% prop title %}}</h1>\n"
+        "<p>{% prop date %}</p>\n{% content %}\n",
+    )
+
+    # markdown posts
+    pages = os.path.join(site_dir, "pages")
+    for i in range(args.posts):
+        body = []
+        for p in range(args.paragraphs):
+            body.append(sentence(rng, rng.randint(40, 120)) + ".")
+            if p % 3 == 1:
+                body.append(f"```python\ndef f{p}(x):\n    return x * {p}  # {sentence(rng, 4)}\n```")
+            if p % 4 == 2:
+                body.append("| a | b |\n|---|---|\n| " + sentence(rng, 2) + " | " + sentence(rng, 2) + " |")
+        write(
+            os.path.join(pages, "posts", f"post{i}.md"),
+            f"{{% def title {sentence(rng, 4)} %}}\n"
+            f"{{% def date 20{rng.randint(10, 23)}-{rng.randint(1, 12):02}-{rng.randint(1, 28):02} %}}\n"
+            "{% template post.html title date %}\n\n" + "\n\n".join(body) + "\n",
+        )
+
+    # notebooks
+    for i in range(args.notebooks):
+        cells = [{"cell_type": "markdown", "source": [f"# {sentence(rng, 4)}\n", sentence(rng, 60)]}]
+        for j in range(args.images):
+            png = png_bytes(rng, 320, 240)
+            cells.append({
+                "cell_type": "code",
+                "source": [f"plot({j})\n", f"# {sentence(rng, 6)}"],
+                "outputs": [
+                    {"text": [sentence(rng, 10)]},
+                    {"data": {"image/png": base64.b64encode(png).decode("ascii")}},
+                ],
+            })
+        notebook = {"metadata": {"language_info": {"name": "python"}}, "cells": cells}
+        header = {
+            "cell_type": "markdown",
+            "source": [
+                f"{{% def title {sentence(rng, 3)} %}}\n",
+                f"{{% def date 2023-01-{i % 28 + 1:02} %}}\n",
+                "{% template post.html title date %}\n",
+            ],
+        }
+        notebook["cells"].insert(0, header)
+        write(os.path.join(pages, "posts", f"notebook{i}.ipynb"), json.dumps(notebook))
+
+    # pages looping over the posts
+    for i in range(args.loops):
+        sort = ["_rsort(posts,date)", "_sort(posts,title)"][i % 2]
+        write(
+            os.path.join(pages, f"list{i}.html"),
+            f"{{% template {parent} %}}\n<ul>\n{{% for post in {sort}\n"
+            "    <li><a href=\"{$post._slug$}\">{$post.title$}</a> {$post.date$}</li> %}\n</ul>\n",
+        )
+
+    # public
+    public = os.path.join(site_dir, "public")
+    for i in range(args.public):
+        directory = os.path.join(public, f"dir{i % 10}")
+        match i % 4:
+            case 0:
+                rule = "".join(f".c{j} {{ margin : {j}px ; }}\n" for j in range(args.public_size // 24))
+                write(os.path.join(directory, f"style{i}.css"), rule)
+            case 1:
+                code = "".join(f"function f{j}(a) {{ return a + {j}; }}\n" for j in range(args.public_size // 36))
+                write(os.path.join(directory, f"script{i}.js"), code)
+            case 2:
+                write(os.path.join(directory, f"image{i}.png"), png_bytes(rng, 200, 150))
+            case 3:
+                write(os.path.join(directory, f"blob{i}.bin"), rng.randbytes(args.public_size))
+
+
+def peak_rss_kb(who=None):
+    """Peak resident memory of this process (or of its largest finished
+    child, like pool workers) in KiB, if the platform tells"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF if who is None else who).ru_maxrss
+    # macOS reports bytes, Linux KiB
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def run_once(site_dir, output_dir, cache_dir, jobs):
+    """Build the website once timing every stage, returns the report"""
+    sssg.get_console().quiet = True
+    stages = {}
+    start = time.perf_counter()
+
+    def stage(name, func, *args):
+        stage_start = time.perf_counter()
+        result = func(*args)
+        stages[name] = time.perf_counter() - stage_start
+        return result
+
+    data = stage("generate_data", sssg.generate_data, site_dir, output_dir)
+    data["_jobs"] = jobs
+    data["_cache_dir"] = cache_dir or None
+    if data["public"]:
+        stage("process_public", sssg.process_public, os.path.join(site_dir, "public"), output_dir)
+    stage("process_pages", sssg.process_pages, data, None, jobs)
+    stage("write_files", sssg.write_files, data)
+    stage("write_assets", sssg.write_assets, data)
+    stage(
+        "minify", sssg.minify, output_dir, None, jobs,
+        data["_cache_dir"], sssg.image_settings(data["_globals"]))
+    wall = time.perf_counter() - start
+    output_bytes = sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, files in os.walk(output_dir) for name in files
+    )
+    return {
+        "wall": wall,
+        "stages": stages,
+        "peak_rss_kb": peak_rss_kb(),
+        "peak_worker_rss_kb": peak_rss_kb(resource.RUSAGE_CHILDREN) if resource else None,
+        "pages": len(data["pages"]),
+        "output_bytes": output_bytes,
+    }
+
+
+def run():
+    """Generate the website, build it `repeat` times and report"""
+    args = parse_arguments()
+    if args.repeat < 1:
+        sys.exit("Need to run at least one build")
+    if args.run_once:
+        site_dir, output_dir, cache_dir = args.run_once
+        print(json.dumps(run_once(site_dir, output_dir, cache_dir, args.jobs)))
+        return
+
+    work_dir = tempfile.mkdtemp(prefix="sssg-bench-")
+    try:
+        site_dir = args.site or os.path.join(work_dir, "site")
+        if os.path.exists(site_dir) and os.listdir(site_dir):
+            sys.exit(f"{site_dir} is not empty")
+        generate_site(site_dir, args)
+        cache_dir = os.path.join(work_dir, "cache") if args.cache else ""
+        runs = []
+        for _ in range(args.repeat):
+            output_dir = os.path.join(work_dir, "out")
+            shutil.rmtree(output_dir, ignore_errors=True)
+            os.makedirs(output_dir)
+            # every build runs in a fresh process so peak memory is its own
+            result = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--jobs", str(args.jobs),
+                 "--run-once", site_dir, output_dir, cache_dir],
+                check=True, capture_output=True, text=True,
+            )
+            runs.append(json.loads(result.stdout))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        "config": {
+            key: value for key, value in vars(args).items()
+            if key not in ("run_once", "output", "site")
+        },
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "markdown": sssg.library_version("Markdown"),
+            "pygments": sssg.library_version("Pygments"),
+            "minify_html_onepass": sssg.library_version("minify_html_onepass"),
+            "pillow": sssg.library_version("Pillow"),
+        },
+        "median": {
+            "wall": statistics.median(run["wall"] for run in runs),
+            "stages": {
+                name: statistics.median(run["stages"][name] for run in runs)
+                for name in runs[0]["stages"]
+            },
+            "peak_rss_kb": (
+                statistics.median(run["peak_rss_kb"] for run in runs)
+                if runs[0]["peak_rss_kb"] is not None else None
+            ),
+        },
+        "runs": runs,
+    }
+    out = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(out + "\n")
+    print(out)
+
+
+if __name__ == "__main__":
+    run()
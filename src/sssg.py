@@ -2,38 +2,185 @@
 
 import re
 import argparse
+import base64
+import bisect
+import gzip
+import hashlib
+import io
 import json
+import mimetypes
 import os
+import socket
 import sys
 import shutil
-import markdown
-import yaml
-import minify_html_onepass
+import threading
+import time
+import urllib.parse
 import operator
-from functools import reduce
-from PIL import Image
-from rich.console import Console
-from rich.theme import Theme
+import posixpath
+from contextlib import contextmanager
+from functools import cache, reduce
+from html import unescape
 
-console = Console(theme=Theme(inherit=False))
+# markdown, yaml, minify_html_onepass, Pillow, Pygments (through codehilite),
+# rich and the process pool are imported by the stages that need them, so
+# small builds and the daemon client start fast
+
+# created on first use, see get_console
+console = None
+# the console theme has no defaults, so tables are given every style
+table_styles = {"header_style": "bold", "footer_style": "", "title_style": "bold cyan"}
 
 md_extensions = ["fenced_code", "tables", "footnotes", "codehilite"]
 
+manifest_file = ".sssg-manifest.json"
+
+# bump when the minified output of the same input changes
+minify_cache_version = "3"
+
+# file types that get a gzip sidecar
+gzip_extensions = (".html", ".css", ".js", ".svg", ".json")
+
+# file types renamed after their contents with --fingerprint, and the map
+# from their names to the fingerprinted ones
+fingerprint_extensions = (
+    ".css", ".js", ".png", ".jpg", ".jpeg", ".gif", ".webp", ".avif", ".svg", ".woff", ".woff2",
+)
+fingerprint_file = "fingerprints.json"
+
+# page weights, also the keys of the `_budgets` section of config.yml, in
+# bytes but for the number of assets
+weight_columns = {
+    "html": "HTML",
+    "gzip": "Gzip",
+    "inline": "Inline",
+    "assets": "Assets",
+    "asset_bytes": "Asset bytes",
+    "total": "Total",
+}
+
+# converters by whether they highlight code, one of each per process,
+# reset between chunks
+markdown_converters = {}
+
+# trace events recorded in this process, None unless profiling
+profile_events = None
+
+
+class Text:
+    """A run of text in a parsed file"""
+
+    __slots__ = ("text",)
+    name = "_content"
+
+    def __init__(self, text):
+        self.text = text
+
+
+class Tag:
+    """A `{% name args... %}` tag in a parsed file"""
+
+    __slots__ = ("name", "args")
+
+    def __init__(self, name, args=()):
+        self.name = name
+        self.args = tuple(args)
+
 
 def get_file_contents(file_path):
     with open(file_path, "r", encoding="utf-8") as f:
         return "".join(f.readlines())
 
 
+def get_console():
+    """Returns the rich console messages are printed on"""
+    global console
+    if console is None:
+        from rich.console import Console
+        from rich.theme import Theme
+
+        console = Console(theme=Theme(inherit=False))
+    return console
+
+
 def error(msg):
     """Print error message and exit"""
-    console.print(f"[red]> {msg}[/red]")
+    get_console().print(f"[red]> {msg}[/red]")
     sys.exit(1)
 
 
 def message(msg):
     """Print a message to the screen"""
-    console.print(f"[green]>[/green] {msg}")
+    get_console().print(f"[green]>[/green] {msg}")
+
+
+def init_profiling(enabled):
+    """Start (or stop) recording trace events in this process"""
+    global profile_events
+    profile_events = [] if enabled else None
+
+
+@contextmanager
+def profiled(name, category="stage"):
+    """Record how long the block takes as a trace event when profiling"""
+    if profile_events is None:
+        yield
+        return
+    start = time.perf_counter_ns()
+    try:
+        yield
+    finally:
+        profile_events.append({
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": start // 1000,
+            "dur": (time.perf_counter_ns() - start) // 1000,
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+        })
+
+
+def take_profile_events():
+    """Returns and clears the trace events recorded so far in this process,
+    used by pool workers to send theirs back"""
+    global profile_events
+    if profile_events is None:
+        return []
+    events, profile_events = profile_events, []
+    return events
+
+
+def write_profile(trace_path, top=15):
+    """Write the recorded events as a Chrome trace and print the slowest
+    stages and files"""
+    from rich.table import Table
+
+    with open(trace_path, "w", encoding="utf-8") as f:
+        json.dump({"traceEvents": profile_events, "displayTimeUnit": "ms"}, f)
+    stages = {}
+    files = {}
+    for event in profile_events:
+        if event["cat"] == "stage":
+            stages[event["name"]] = stages.get(event["name"], 0) + event["dur"]
+        else:
+            key = (event["cat"], event["name"])
+            files[key] = files.get(key, 0) + event["dur"]
+
+    table = Table(title="Slowest stages", **table_styles)
+    table.add_column("Stage")
+    table.add_column("Time (ms)", justify="right")
+    for name, duration in sorted(stages.items(), key=lambda x: -x[1])[:top]:
+        table.add_row(name, f"{duration / 1000:.1f}")
+    get_console().print(table)
+    table = Table(title="Slowest files", **table_styles)
+    table.add_column("File")
+    table.add_column("Step")
+    table.add_column("Time (ms)", justify="right")
+    for (category, name), duration in sorted(files.items(), key=lambda x: -x[1])[:top]:
+        table.add_row(name, category, f"{duration / 1000:.1f}")
+    get_console().print(table)
+    message(f"Trace written to {trace_path}, open it in chrome://tracing or ui.perfetto.dev")
 
 
 def leftover_path(shorter_path, longer_path):
@@ -46,7 +193,7 @@ def leftover_path(shorter_path, longer_path):
     return longer_path[i:]
 
 
-def parse_arguments():
+def parse_arguments(argv=None):
     """Parse and return comman dline arguments"""
     parser = argparse.ArgumentParser(
         prog="sssg", description="Simple Static Site Generator"
@@ -58,22 +205,168 @@ def parse_arguments():
     parser.add_argument(
         "-o",
         "--outputdir",
-        help="output directory of your compiled website",
-        required=True,
+        help="output directory of your compiled website (not needed with --serve or --daemon)",
+    )
+    parser.add_argument(
+        "--incremental",
+        help="only rebuild outputs whose inputs changed since the last build",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--watch",
+        help="keep running and rebuild the pages affected by every change",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-j", "--jobs",
+        help="number of processes rendering pages, 0 uses every core (default 1)",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--cachedir",
+        help="directory of the persistent minify cache (default <inputdir>/.sssg-cache)",
+    )
+    parser.add_argument(
+        "--nocache",
+        help="do not use the persistent minify cache",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--stream",
+        help="read, render, write and minify pages one at a time to keep memory low",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--hardlink",
+        help="hardlink public files into the output directory instead of copying them",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--fingerprint",
+        help="copy CSS, JS, images and fonts to name.<hash>.ext and rewrite the references to them",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--gzip",
+        help="write a maximum level gzip sidecar (.gz) next to HTML, CSS, JS, SVG and JSON outputs",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--gzip-min-size",
+        help="only compress files of at least this many bytes (default 1024)",
+        type=int,
+        default=1024,
+        metavar="BYTES",
     )
-    args = parser.parse_args()
+    parser.add_argument(
+        "--profile",
+        help="time every stage and file of the build and write a Chrome trace (default sssg-trace.json)",
+        nargs="?",
+        const="sssg-trace.json",
+        metavar="TRACE_FILE",
+    )
+    parser.add_argument(
+        "--weights",
+        help="report the weight of the N heaviest pages (default 10)",
+        nargs="?",
+        type=int,
+        const=10,
+        metavar="N",
+    )
+    parser.add_argument(
+        "--shard",
+        help="only build the outputs of shard I of N (1/4 to 4/4), for merging with --merge",
+        metavar="I/N",
+    )
+    parser.add_argument(
+        "--merge",
+        help="combine the outputs of shard builds into the output directory",
+        nargs="+",
+        metavar="SHARD_DIR",
+    )
+    parser.add_argument(
+        "--daemon",
+        help="keep a warm process for the input directory that runs the builds sent with --client",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--client",
+        help="send this build to the daemon running for the input directory",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--serve",
+        help="serve the website from memory, rendering pages as they are requested",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--port", help="port to serve on (default 8000)", type=int, default=8000
+    )
+    parser.add_argument(
+        "--minify",
+        help="minify pages and images when serving",
+        action="store_true",
+    )
+    args = parser.parse_args(argv)
+    args.incremental = args.incremental or args.watch
+    if args.stream and (args.watch or args.serve):
+        error("Streaming builds cannot be combined with --watch or --serve")
+    if (args.daemon or args.client) and (args.watch or args.serve or args.stream):
+        error("--daemon and --client cannot be combined with --watch, --serve or --stream")
+    if args.daemon and args.client:
+        error("Choose one of --daemon and --client")
+    if args.profile and args.serve:
+        error("Profiling cannot be combined with --serve")
+    if args.jobs < 0:
+        error("Number of jobs cannot be negative")
+    if args.gzip_min_size < 0:
+        error("Minimum gzip size cannot be negative")
+    if args.weights is not None and args.weights < 1:
+        error("Need to report at least one page")
+    args.jobs = args.jobs or os.cpu_count() or 1
+    if args.shard:
+        if args.watch or args.serve or args.daemon or args.merge:
+            error("--shard cannot be combined with --watch, --serve, --daemon or --merge")
+        if args.fingerprint:
+            error("Fingerprint sharded builds when merging them with --merge --fingerprint")
+        try:
+            index, count = (int(x) for x in args.shard.split("/"))
+        except ValueError:
+            error(f"Invalid shard '{args.shard}', expected I/N like 1/4")
+        if not 1 <= index <= count:
+            error(f"Invalid shard '{args.shard}', I has to be between 1 and N")
+        args.shard = (index, count)
+    if args.merge:
+        if args.watch or args.serve or args.daemon or args.client or args.stream or args.incremental:
+            error("--merge cannot be combined with --watch, --serve, --daemon, --client, --stream or --incremental")
+        for shard_dir in args.merge:
+            if not os.path.isdir(shard_dir):
+                error(f"Invalid shard directory '{shard_dir}'")
+    if args.serve or args.daemon:
+        if not os.path.exists(args.inputdir):
+            error("Invalid directory paths given")
+        return args
+    if not args.outputdir:
+        error("Output directory is required unless serving")
     if (not os.path.exists(args.inputdir)) or (not os.path.exists(args.outputdir)):
         error("Invalid directory paths given")
     if len(os.listdir(args.outputdir)) != 0:
-        error(
-            "Output directory not empty, delete everything inside the output directory"
-        )
+        if not args.incremental:
+            error(
+                "Output directory not empty, delete everything inside the output directory"
+            )
+        if not os.path.exists(os.path.join(args.outputdir, manifest_file)):
+            error(
+                "Output directory has no build manifest, do a full build into an empty directory first"
+            )
     return args
 
 
-def get_tree(input_dir):
+def get_tree(input_dir, data=None, light=False):
     """Walks the directory and returns the syntax tree assuming all files are
-    compatible with templating engine"""
+    compatible with templating engine. If `data` is given, notebook images
+    are extracted into its assets. Light trees keep only the tags"""
     tree = {}
     input_root = ""
 
@@ -82,41 +375,91 @@ def get_tree(input_dir):
             input_root = root
         for name in files:
             file_path = os.path.join(root, name)
-            leftover = leftover_path(input_root, file_path)
-            if file_path.endswith(".ipynb"):
-                tree[leftover] = get_ipynb_tree(file_path)
-            else:
-                tree[leftover] = get_text_tree(get_file_contents(file_path))
+            page = leftover_path(input_root, file_path)
+            with profiled(page, "parse"):
+                if data is None:
+                    tree[page] = get_file_tree(file_path)
+                else:
+                    tree[page] = get_file_tree(
+                        file_path, page, data["assets"],
+                        notebook_settings(data["_globals"]), light)
+            if light:
+                tree[page] = [node for node in tree[page] if node.name != "_content"]
     return tree
 
 
-def get_ipynb_tree(file_path):
-    """convert ipynb to markdown"""
-    out = ""
+def get_file_tree(file_path, page=None, assets=None, settings=None, light=False):
+    """Returns the syntax tree of a single file"""
+    if file_path.endswith(".ipynb"):
+        return get_ipynb_tree(file_path, assets, page, settings, not light)
+    return get_text_tree(get_file_contents(file_path))
+
+
+def notebook_settings(globals):
+    """Reads the `_notebooks` section of config.yml"""
+    settings = (globals or {}).get("_notebooks") or {}
+    return {"inline_limit": int(settings.get("inline_limit", 0))}
+
+
+def forget_assets(assets, page):
+    """Drop a page from the sources of its notebook assets, deleting the
+    assets no other page produces"""
+    for path in list(assets):
+        assets[path]["pages"].discard(page)
+        if not assets[path]["pages"]:
+            del assets[path]
+
+
+def get_ipynb_tree(file_path, assets=None, page=None, settings=None, keep_contents=True):
+    """convert ipynb to markdown. If `assets` is given, image outputs larger
+    than the inline limit are stored there as content-hashed files next to
+    the page instead of being inlined, without their contents unless
+    `keep_contents` is set"""
+    inline_limit = settings["inline_limit"] if settings else 0
+    out = []
+    # last two characters written, to know how the previous cell ended
+    tail = ""
     regex = r"{%(.*?)%}"
+
+    def write(text):
+        nonlocal tail
+        out.append(text)
+        tail = (tail + text)[-2:]
+
+    def extract(contents, ext):
+        if assets is None or len(contents) <= inline_limit:
+            return None
+        name = hashlib.sha256(contents).hexdigest()[:16] + ext
+        path = os.path.join(os.path.dirname(page), name)
+        assets.setdefault(
+            path, {"contents": contents if keep_contents else None, "pages": set()})
+        assets[path]["pages"].add(page)
+        return f"<img src='{name}' />"
+
     with open(file_path, "r", encoding="utf-8") as f:
         data = json.load(f)
     lang = data["metadata"]["language_info"]["name"]
     for cell in data["cells"]:
         if cell["cell_type"] == "markdown":
             for text in cell["source"]:
-                out += text
+                write(text)
         elif cell["cell_type"] == "code":
-            code = ""
-            text_output = ""
-            plain_output = ""
+            code = []
+            text_output = []
+            plain_output = []
             for text in cell["source"]:
                 match = re.search(regex, text, flags=re.S)
                 if match and match.group(1).strip() == "out_only":
-                    code = ""
+                    code = []
                     break
                 else:
-                    code += text
+                    code.append(text)
+            code = "".join(code)
             if code:
-                out += f"```{lang}\n{code.strip()}\n```\n\n"
+                write(f"```{lang}\n{code.strip()}\n```\n\n")
             for output in cell["outputs"]:
                 if "text" in output:
-                    text_output += "".join(output["text"])
+                    text_output.append("".join(output["text"]))
                 if "data" in output:
                     data_block = output["data"]
                     for data_type, content in data_block.items():
@@ -125,55 +468,83 @@ def get_ipynb_tree(file_path):
                                 c = "".join(map(lambda x: x.strip(), content))
                                 start_idx = c.find("<svg")
                                 end_idx = c.rfind("/svg>")
-                                plain_output += c[start_idx:end_idx+5]
+                                svg = c[start_idx:end_idx+5]
+                                plain_output.append(
+                                    extract(svg.encode("utf-8"), ".svg") or svg)
                             case "image/png":
-                                plain_output += f"<img src='data:image/png;base64, {content}' />"
+                                content = "".join(content)
+                                plain_output.append(
+                                    extract(base64.b64decode(content), ".png")
+                                    or f"<img src='data:image/png;base64, {content}' />")
                             case "image/jpeg":
-                                plain_output += f"<img src='data:image/jpeg;base64, {content}' />"
+                                content = "".join(content)
+                                plain_output.append(
+                                    extract(base64.b64decode(content), ".jpg")
+                                    or f"<img src='data:image/jpeg;base64, {content}' />")
+            text_output = "".join(text_output)
+            plain_output = "".join(plain_output)
             if text_output:
-                out += f"```output\n{text_output.strip()}\n```\n\n"
+                write(f"```output\n{text_output.strip()}\n```\n\n")
             if plain_output:
-                out += plain_output.strip()
+                write(plain_output.strip())
         # new cell = new paragaraph
-        if not out.endswith("\n"):
-            out += "\n\n"
-        elif out.endswith("\n") and not out.endswith("\n\n"):
-            out += "\n"
-    return get_text_tree(out)
+        if not tail.endswith("\n"):
+            write("\n\n")
+        elif tail.endswith("\n") and not tail.endswith("\n\n"):
+            write("\n")
+    return get_text_tree("".join(out))
 
 
 def get_text_tree(page_contents):
-    """convert text types to tree representation"""
+    """convert text types to a list of Text and Tag nodes"""
     regex = r"{%(.*?)%}"
     tree = []
-    matches = [match for match in re.finditer(regex, page_contents, flags=re.S)]
     curr_ptr = 0
-    match_ptr = 0
-    while match_ptr < len(matches):
+    for match in re.finditer(regex, page_contents, flags=re.S):
         # parse content
-        content = page_contents[curr_ptr: matches[match_ptr].start()]
-        tag = matches[match_ptr].group(1).strip().split(" ")
+        content = page_contents[curr_ptr: match.start()]
+        tag = match.group(1).strip().split(" ")
         if content:
-            tree.append(("_content", content))
-        tree.append(tuple(tag))
-        curr_ptr = matches[match_ptr].end()
-        match_ptr += 1
+            tree.append(Text(content))
+        tree.append(Tag(tag[0], tag[1:]))
+        curr_ptr = match.end()
     if curr_ptr < len(page_contents):
-        tree.append(("_content", page_contents[curr_ptr:]))
+        tree.append(Text(page_contents[curr_ptr:]))
     return tree
 
 
-def generate_data(input_dir, output_dir):
-    """Reads and returns a convenient structure for processing files"""
+def load_config(input_dir):
+    """Returns the contents of config.yml, None if there is none"""
+    config_file_path = os.path.join(input_dir, "config.yml")
+    if not os.path.exists(config_file_path):
+        return None
+    import yaml
+
+    with profiled("config.yml", "yaml"), open(config_file_path, "r", encoding="utf-8") as file:
+        return yaml.safe_load(file)
+
+
+def generate_data(input_dir, output_dir, light=False):
+    """Reads and returns a convenient structure for processing files. Light
+    data keeps only the tags of pages and no notebook image contents, for
+    streaming builds that read each page again when rendering it"""
     data = {"_input_dir": input_dir, "_output_dir": output_dir}
+    data["_jobs"] = 1
+    data["_cache_dir"] = None
+    data["_stream"] = light
+    data["_gzip"] = None
+    data["_fingerprint"] = False
+    data["_weights"] = None
+    data["_shard"] = None
+    data["_hardlink"] = False
+    data["_input_stats"] = None
     data["_globals"] = None
     data["public"] = False
+    data["assets"] = {}
+    data["search"] = {}
 
     # config file read
-    config_file_path = os.path.join(input_dir, "config.yml")
-    if os.path.exists(config_file_path):
-        with open(config_file_path, "r", encoding="utf-8") as file:
-            data["_globals"] = yaml.safe_load(file)
+    data["_globals"] = load_config(input_dir)
 
     # directories read
     for file in os.listdir(input_dir):
@@ -184,389 +555,2401 @@ def generate_data(input_dir, output_dir):
             elif file == "templates":
                 data["templates"] = get_tree(os.path.join(input_dir, file))
             elif file == "pages":
-                data["pages"] = get_tree(os.path.join(input_dir, file))
+                data["pages"] = get_tree(os.path.join(input_dir, file), data, light)
     return data
 
 
-def process_public(public_dir, output_dir):
-    """Copies everything inside the public directory to the output dir"""
+def output_name(file):
+    """Returns the name a page is written under in the output directory"""
+    if file.endswith(".md"):
+        return file[:-3] + ".html"
+    if file.endswith(".ipynb"):
+        return file[:-6] + ".html"
+    return file
+
+
+def parse_loop_source(source):
+    """Split the directory part of a for loop into (root, sort_key, reversed,
+    per_page). per_page is the page size given as a third sort argument, as
+    a string, or None if the loop is not paginated"""
+    sort_key = None
+    reversed = False
+    per_page = None
+    root = source.strip()
+    if source.find("sort(") != -1:
+        opening = source.find("(")
+        closing = source.rfind(")")
+        starting = source.find(",")
+        sort_key = source[starting + 1:closing].strip()
+        if "," in sort_key:
+            sort_key, per_page = (x.strip() for x in sort_key.rsplit(",", 1))
+        if source.find("rsort(") != -1:
+            reversed = True
+        root = source[opening + 1:starting].strip()
+    return root, sort_key, reversed, per_page
+
+
+def paginated_loop(file, contents):
+    """Returns (source, page size) of the paginated for loop of a page, or
+    None if it has none. A page can only have one"""
+    found = None
+    for node in contents:
+        if node.name != "for" or len(node.args) < 3 or not node.args[2].startswith("_"):
+            continue
+        per_page = parse_loop_source(node.args[2])[3]
+        if per_page is None:
+            continue
+        if found:
+            error(f"You cannot have more than one paginated for loop inside '{file}'")
+        if not per_page.isdigit() or int(per_page) < 1:
+            error(f"Page size of for loop in '{file}' must be a positive number")
+        found = (node.args[2], int(per_page))
+    return found
+
+
+def shard_count(items, per_page):
+    """Number of pages a paginated loop over `items` entries is split into"""
+    return max(1, -(-items // per_page))
+
+
+def shard_name(file, number):
+    """Output name of a page of a paginated page, blog.html, blog/2.html..."""
+    if number == 1:
+        return file
+    root, ext = os.path.splitext(file)
+    return f"{root}/{number}{ext}"
+
+
+def page_outputs(data):
+    """Returns a dict of page output name -> every output it is rendered to,
+    more than one for pages with a paginated loop. Loops go through the pages
+    with defs, so counting those is enough to know the number of pages"""
+    outputs = {}
+    with_defs = None
+    for file, contents in data["pages"].items():
+        name = output_name(file)
+        loop = paginated_loop(file, contents)
+        if loop is None:
+            outputs[name] = [name]
+            continue
+        if with_defs is None:
+            with_defs = [
+                output_name(page) for page, nodes in data["pages"].items()
+                if any(node.name == "def" for node in nodes)
+            ]
+        root = parse_loop_source(loop[0])[0]
+        items = sum(1 for page in with_defs if page.startswith(root))
+        outputs[name] = [
+            shard_name(name, number) for number in range(1, shard_count(items, loop[1]) + 1)
+        ]
+    return outputs
+
+
+def hash_file(file_path):
+    """Returns the sha256 hex digest of a file's contents, read in chunks so
+    large public files are never held in memory whole"""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        while chunk := f.read(1 << 20):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def input_files(input_dir):
+    """Yields every file the build reads, relative to input dir"""
+    for directory in ("pages", "templates", "public"):
+        for root, _, files in os.walk(os.path.join(input_dir, directory)):
+            for name in files:
+                yield leftover_path(input_dir, os.path.join(root, name))
+    if os.path.exists(os.path.join(input_dir, "config.yml")):
+        yield "config.yml"
+
+
+def hash_inputs(input_dir, stats=None, manifest=None):
+    """Hash every file the build reads, keyed by path relative to input dir.
+    Given the current `stats` of the files (see snapshot), files with the
+    modification time and size recorded in the previous build's `manifest`
+    keep their old hash instead of being read again"""
+    if stats is None:
+        stats = snapshot(input_dir)
+    old_hashes = (manifest or {}).get("inputs", {})
+    old_stats = (manifest or {}).get("stats", {})
+    hashes = {}
+    for file, stat in stats.items():
+        if file in old_hashes and tuple(old_stats.get(file, ())) == stat:
+            hashes[file] = old_hashes[file]
+        else:
+            hashes[file] = hash_file(os.path.join(input_dir, file))
+    return hashes
+
+
+def dependency_hash(dependency, hashes):
+    """Hash of a dependency given the input hashes. Dependencies ending with
+    '*' cover every input whose path starts with the rest of the name"""
+    if dependency.endswith("*"):
+        prefix = dependency[:-1]
+        combined = hashlib.sha256()
+        for path in sorted(hashes):
+            if path.startswith(prefix):
+                combined.update(f"{path}:{hashes[path]};".encode("utf-8"))
+        return combined.hexdigest()
+    return hashes.get(dependency)
+
+
+def get_dependencies(data):
+    """Returns a dict of output file -> input files it is rendered from,
+    following template and expand tags through nested templates"""
+    template_refs = {}
+    template_globals = set()
+    for file, contents in data["templates"].items():
+        template_refs[file] = {
+            node.args[0] for node in contents
+            if node.name in ("template", "expand") and node.args
+        }
+        if any(node.name == "global" for node in contents):
+            template_globals.add(file)
+
+    def template_closure(names):
+        seen = set()
+        stack = list(names)
+        while stack:
+            name = stack.pop()
+            if name in seen:
+                continue
+            seen.add(name)
+            stack += template_refs.get(name, ())
+        return seen
+
+    dependencies = {}
+    for file, contents in data["pages"].items():
+        deps = {os.path.join("pages", file)}
+        names = set()
+        for node in contents:
+            if node.name in ("template", "expand") and node.args:
+                names.add(node.args[0])
+            elif node.name == "global":
+                deps.add("config.yml")
+            elif node.name == "for" and len(node.args) > 2:
+                if node.args[2].startswith("_"):
+                    root = parse_loop_source(node.args[2])[0]
+                    deps.add(os.path.join("pages", root) + "*")
+                if "_global" in " ".join(node.args[3:]):
+                    deps.add("config.yml")
+        names = template_closure(names)
+        deps |= {os.path.join("templates", name) for name in names}
+        # what goes in the search index is configured in config.yml
+        if names & template_globals or "_search" in (data["_globals"] or {}):
+            deps.add("config.yml")
+        # so is which notebook images are inlined
+        if file.endswith(".ipynb") and "_notebooks" in (data["_globals"] or {}):
+            deps.add("config.yml")
+        dependencies[output_name(file)] = sorted(deps)
+    for name, shards in page_outputs(data).items():
+        for shard in shards[1:]:
+            dependencies[shard] = dependencies[name]
+    for file, asset in data["assets"].items():
+        dependencies[file] = sorted(os.path.join("pages", page) for page in asset["pages"])
+        # inlining and image variants are configured in config.yml
+        if "_notebooks" in (data["_globals"] or {}) or (
+            is_image(file) and "_images" in (data["_globals"] or {})
+        ):
+            dependencies[file].insert(0, "config.yml")
+    for file in list_public_files(data):
+        dependencies[file] = [os.path.join("public", file)]
+        # image variants are configured in config.yml
+        if is_image(file) and "_images" in (data["_globals"] or {}):
+            dependencies[file].insert(0, "config.yml")
+    return dependencies
+
+
+def list_public_files(data):
+    """Returns the files of the public directory, relative to it"""
+    if not data["public"]:
+        return []
+    public_dir = os.path.join(data["_input_dir"], "public")
+    return [
+        leftover_path(public_dir, os.path.join(root, name))
+        for root, _, files in os.walk(public_dir) for name in files
+    ]
+
+
+def load_manifest(output_dir):
+    """Returns the manifest of the previous build, if there is one"""
+    manifest_path = os.path.join(output_dir, manifest_file)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_manifest(
+    output_dir, hashes, dependencies, compressed=None, stats=None, shard=None, weights=None,
+    variants=None,
+):
+    """Record input hashes, output dependencies and the hashes of the outputs
+    with gzip sidecars for the next build. The modification time and size
+    of inputs in `stats` let the next build skip hashing them again. Shard
+    builds record which (index, count) shard they are, and `weights` are the
+    weights of the pages, kept for the pages the next build does not minify.
+    `variants` are the variants made of each image, removed when the next
+    build no longer makes them"""
+    manifest = {"inputs": hashes, "outputs": dependencies}
+    if compressed is not None:
+        manifest["compressed"] = compressed
+    if shard is not None:
+        manifest["shard"] = list(shard)
+    if weights is not None:
+        manifest["weights"] = weights
+    if variants:
+        manifest["variants"] = variants
+    if stats is not None:
+        # a file modified again within the same clock tick would look
+        # unchanged, so recently modified files are hashed next time too
+        recent = time.time_ns() - 2_000_000_000
+        manifest["stats"] = {
+            file: stat for file, stat in stats.items()
+            if file in hashes and stat[0] < recent
+        }
+    with open(os.path.join(output_dir, manifest_file), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+
+
+def changed_outputs(manifest, hashes, dependencies):
+    """Compare against the previous build manifest and return a tuple of
+    (outputs to rebuild, outputs whose sources disappeared)"""
+    old_hashes = manifest["inputs"]
+    old_outputs = manifest["outputs"]
+    dirty = set()
+    for file, deps in dependencies.items():
+        if file not in old_outputs or old_outputs[file] != deps:
+            dirty.add(file)
+            continue
+        for dep in deps:
+            if dependency_hash(dep, old_hashes) != dependency_hash(dep, hashes):
+                dirty.add(file)
+                break
+    removed = set(old_outputs) - set(dependencies)
+    return dirty, removed
+
+
+def affected_outputs(changed, dependencies):
+    """Returns the outputs that depend on any of the changed input files"""
+    affected = set()
+    for file, deps in dependencies.items():
+        for dep in deps:
+            if dep in changed or (
+                dep.endswith("*") and any(c.startswith(dep[:-1]) for c in changed)
+            ):
+                affected.add(file)
+                break
+    return affected
+
+
+def remove_outputs(output_dir, files, settings=None, variants=None):
+    """Delete outputs whose sources disappeared along with their image
+    variants, those `variants` recorded and those `settings` make, gzip
+    sidecars and emptied directories"""
+    output_dir = os.path.abspath(output_dir)
+    variants = [
+        path for file in files if is_image(file)
+        for path in (variants or {}).get(file, []) + [
+            path for path, _, _ in image_variants(file, float("inf"), settings)]
+    ]
+    sidecars = [file + ".gz" for file in files if file.endswith(gzip_extensions)]
+    for file in list(files) + variants + sidecars:
+        file_path = os.path.join(output_dir, file)
+        if not os.path.exists(file_path):
+            continue
+        message(f"Removing: {file}")
+        os.remove(file_path)
+        parent = os.path.dirname(file_path)
+        while parent != output_dir and not os.listdir(parent):
+            os.rmdir(parent)
+            parent = os.path.dirname(parent)
+
+
+def copy_file(source, destination, link=False):
+    """Copy a file keeping its metadata, or hardlink it if `link` is set and
+    both are on the same filesystem. Copies go through copy_file_range where
+    available so the kernel (or a copy-on-write filesystem) moves the data"""
+    if os.path.lexists(destination):
+        # never write through a hardlink made by a previous build
+        os.remove(destination)
+    if link:
+        try:
+            os.link(source, destination)
+            return
+        except OSError:
+            pass
+    if hasattr(os, "copy_file_range"):
+        try:
+            with open(source, "rb") as src, open(destination, "wb") as dst:
+                remaining = os.fstat(src.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(src.fileno(), dst.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+            if remaining == 0:
+                shutil.copystat(source, destination)
+                return
+        except OSError:
+            pass
+    shutil.copy2(source, destination)
+
+
+def process_public(public_dir, output_dir, only=None, link=False):
+    """Copies everything inside the public directory to the output dir.
+    If `only` is given, just those files relative to public dir are copied.
+    With `link` files are hardlinked instead when possible"""
     message("Copying over public files...")
-    shutil.copytree(public_dir, output_dir, dirs_exist_ok=True)
+    if only is None:
+        only = []
+        for root, _, files in os.walk(public_dir):
+            os.makedirs(os.path.join(output_dir, leftover_path(public_dir, root)), exist_ok=True)
+            only.extend(leftover_path(public_dir, os.path.join(root, name)) for name in files)
+    for file in only:
+        os.makedirs(os.path.dirname(os.path.join(output_dir, file)), exist_ok=True)
+        copy_file(os.path.join(public_dir, file), os.path.join(output_dir, file), link)
 
 
-def process_pages(data):
-    """Parse pages and templates directory to create final files"""
-    variables = {}
+def def_processor(variables, file, contents, reject=False):
+    """Collect the defs of a file into variables"""
+    for node in contents:
+        if node.name == "def":
+            if reject:
+                error(f"You are not allowed to use defs inside '{file}'")
+            variables.setdefault(file, {})
+            value = " ".join(node.args[1:]).strip()
+            var_name = node.args[0]
+            if not value:
+                error(
+                    f"You must provide a value for '{var_name}' in '{file}'")
+            variables[file][var_name] = value
+            # add slug speciala variabel
+            if not variables[file].get("_slug"):
+                slug = file.replace("\\", "/")
+                if not slug.startswith("/"):
+                    slug = f"/{slug}"
+                variables[file]["_slug"] = slug
 
-    def def_processor(file, contents, reject=False):
-        new_contents = []
-        for item in contents:
-            if item[0] == "def":
-                if reject:
-                    error(f"You are not allowed to use defs inside '{file}'")
-                variables.setdefault(file, {})
-                value = " ".join(item[2:]).strip()
-                var_name = item[1]
-                if not value:
-                    error(
-                        f"You must provide a value for '{var_name}' in '{file}'")
-                variables[file][var_name] = value
-                # add slug speciala variabel
-                if not variables[file].get("_slug"):
-                    slug = file.replace("\\", "/")
-                    if not slug.startswith("/"):
-                        slug = f"/{slug}"
-                    variables[file]["_slug"] = slug
-            else:
-                new_contents.append(item)
-        return new_contents
-
-    def use_processor(file, contents, reject=False):
-        new_contents = []
-        for item in contents:
-            if item[0] == "use":
-                if reject:
-                    error(f"You are not allowed to use use inside '{file}'")
-                try:
-                    new_contents.append(("_content", variables[file][item[1]]))
-                except Exception:
-                    error(
-                        f"Error processing variable '{item[1]}' for '{file}'")
-            else:
-                new_contents.append(item)
-        return new_contents
 
-    def globals_processor(file, contents):
-        new_contents = []
-        for item in contents:
-            if item[0] == "global":
-                try:
-                    new_contents.append(
-                        ("_content", data["_globals"][item[1]]))
-                except Exception:
-                    error(
-                        f"Error processing global variable '{item[1]}' for '{file}'")
-            else:
-                new_contents.append(item)
-        return new_contents
+def use_value(context, file, name):
+    """Value of a def of the page"""
+    try:
+        return context["variables"][file][name]
+    except Exception:
+        error(f"Error processing variable '{name}' for '{file}'")
+
+
+def global_value(context, file, name):
+    """Value of a global variable from config.yml"""
+    try:
+        return context["globals"][name]
+    except Exception:
+        error(f"Error processing global variable '{name}' for '{file}'")
+
+
+def merge_contents(contents):
+    """Merge runs of adjacent strings into one. Non text values (like
+    numbers from config.yml) are left alone for the final merge to report"""
+    new_contents = []
+    for piece in contents:
+        if (
+            isinstance(piece, str) and new_contents
+            and isinstance(new_contents[-1], str)
+        ):
+            new_contents[-1] = new_contents[-1] + piece
+        else:
+            new_contents.append(piece)
+    return new_contents
 
-    def expand_processor(file, contents):
-        new_contents = []
-        for item in contents:
-            if item[0] == "expand":
-                try:
-                    new_contents += data["templates"][item[1]]
-                except Exception:
-                    error(f"Error expanding template '{item[1]}' for '{file}'")
-            else:
-                new_contents.append(item)
-        return new_contents
 
-    def template_processor(file, contents, ignore_props=False):
-        new_contents = []
+def compile_templates(context, templates):
+    """Resolve globals, expands and nested templates inside every template
+    once. Each compiled template holds its resolved pieces (values and left
+    over tags) and the pieces before and after its content slot, or None for
+    both if the template has no slot"""
+    compiled = {}
+    resolving = set()
+
+    def lookup(name, file, msg):
+        if name not in templates:
+            if msg.startswith("Cannot") and file.endswith(".html"):
+                file = file[:-5]
+            error(msg.format(name=name, file=file))
+        return resolve(name)
+
+    def resolve(file):
+        if file in compiled:
+            return compiled[file]
+        if file in resolving:
+            error(f"Template '{file}' ends up including itself")
+        resolving.add(file)
+        pieces = []
         template = None
-        for item in contents:
-            if item[0] == "template":
-                if not template:
-                    template = item
-                else:
+        for node in templates[file]:
+            if node.name == "_content":
+                pieces.append(node.text)
+            elif node.name == "global":
+                pieces.append(global_value(context, file, node.args[0]))
+            elif node.name == "use":
+                error(f"You are not allowed to use use inside '{file}'")
+            elif node.name == "expand":
+                pieces += lookup(
+                    node.args[0], file,
+                    "Error expanding template '{name}' for '{file}'")["pieces"]
+            elif node.name == "template":
+                if template:
                     error(
                         f"You cannot have more than one template declarations inside '{file}'"
                     )
+                template = node
             else:
-                new_contents.append(item)
-
+                pieces.append(node)
         if template:
-            # expand template
-            try:
-                template_data = data["templates"][template[1]]
-            except Exception:
-                if file.endswith(".html"):
-                    file = file[:-5]
+            parent = lookup(
+                template.args[0], file,
+                "Cannot find template '{name}' for file '{file}'")
+            if parent["before"] is not None:
+                pieces = parent["before"] + pieces + parent["after"]
+        pieces = merge_contents(pieces)
+        compiled[file] = {"pieces": pieces, "before": None, "after": None}
+        for i, piece in enumerate(pieces):
+            if isinstance(piece, Tag) and piece.name == "content":
+                compiled[file]["before"] = pieces[:i]
+                compiled[file]["after"] = pieces[i + 1:]
+                break
+        resolving.discard(file)
+        return compiled[file]
+
+    for file in templates:
+        resolve(file)
+    return compiled
+
+
+@cache
+def library_version(name):
+    """Installed version of a library, for cache keys"""
+    from importlib.metadata import version
+
+    return version(name)
+
+
+def replace_file(file_path, contents):
+    """Write bytes under a temporary name and rename it over `file_path`, so
+    readers never see a partial file and hardlinks to the old file are left
+    untouched"""
+    temp_path = f"{file_path}.{os.getpid()}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(contents)
+    os.replace(temp_path, file_path)
+
+
+def write_cache(cache_path, contents):
+    """Store bytes in a cache file. The file is written under a temporary
+    name and renamed so concurrent workers never see partial entries"""
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    replace_file(cache_path, contents)
+
+
+def markdown_cache_key(text):
+    """Cache key of a chunk's html, covering extensions and library versions"""
+    key = hashlib.sha256()
+    key.update(
+        f"{','.join(md_extensions)}:{library_version('Markdown')}:{library_version('Pygments')};"
+        .encode("utf-8")
+    )
+    key.update(text.encode("utf-8"))
+    return key.hexdigest()
+
+
+def has_code_blocks(text):
+    """Whether a chunk of markdown may have code blocks to highlight. Fenced
+    and indented blocks, also inside blockquotes, are all that codehilite
+    touches"""
+    return "```" in text or "~~~" in text or re.search(r"^[> \t]*( {4}|\t)", text, re.M) is not None
+
+
+def markdown_converter(highlight):
+    """Returns the converter of this process, with codehilite if `highlight`"""
+    if highlight not in markdown_converters:
+        import markdown
+
+        markdown_converters[highlight] = markdown.Markdown(extensions=[
+            extension for extension in md_extensions
+            if highlight or extension != "codehilite"
+        ])
+    return markdown_converters[highlight]
+
+
+def convert_markdown(file, text, cache_dir=None):
+    """Convert a chunk of markdown to html. Chunks converted before are read
+    from the render cache in `cache_dir`. Chunks without code blocks skip
+    codehilite, so Pygments is only loaded for pages that have code"""
+    cache_path = None
+    if cache_dir:
+        key = markdown_cache_key(text)
+        cache_path = os.path.join(cache_dir, "markdown", key[:2], key)
+        if os.path.exists(cache_path):
+            with open(cache_path, "rb") as f:
+                return f.read().decode("utf-8")
+    try:
+        with profiled(file, "markdown"):
+            html = markdown_converter(has_code_blocks(text)).reset().convert(text)
+            # a code block the check missed is converted again with codehilite
+            if "<pre><code" in html and not has_code_blocks(text):
+                html = markdown_converter(True).reset().convert(text)
+    except Exception:
+        error(f"Error error converting markdown '{text}' for '{file}'")
+    if cache_path:
+        write_cache(cache_path, html.encode("utf-8"))
+    return html
+
+
+def parse_loop_content(file, loop_var, content):
+    """Split the content of a for loop into text and the pieces filled in per
+    loop variable: ("loop_var", keys), ("use", name) or ("global", name)"""
+    regex = r"\{\$(.*?)\$\}"
+    parsed_content = []
+    curr = 0
+    for match in re.finditer(regex, content):
+        var = match.group(1).strip()
+        parsed_content.append(content[curr: match.start()])
+        var_tree = var.split(".")
+        if var.startswith(loop_var):
+            parsed_content.append(("loop_var", var_tree[1:]))
+        elif var.startswith("this"):
+            if len(var_tree) != 2:
                 error(
-                    f"Cannot find template '{template[1]}' for file '{file}'")
-            template_props = set(template[2:])
-            for i, item in enumerate(template_data):
-                if item[0] == "content":
-                    new_contents = template_data[:i] + new_contents
-                    if i + 1 < len(template_data):
-                        new_contents += template_data[i + 1:]
-                    break
-            # expand props
-            if not ignore_props:
-                prop_expanded_contents = []
-                for i, item in enumerate(new_contents):
-                    if item[0] == "prop":
-                        if item[1] not in template_props:
-                            error(
-                                f"Prop '{item[1]}' not passed to the page '{template[1]}'"
-                            )
-                        else:
-                            prop_expanded_contents.append(
-                                ("_content", variables[file][item[1]])
-                            )
-                    else:
-                        prop_expanded_contents.append(item)
-                new_contents = prop_expanded_contents
-            # recurse to see if there is more tempaltes
-            new_contents = template_processor(file, new_contents, ignore_props)
-        return new_contents
-
-    def content_processor(file, contents):
-        new_contents = []
-        current_contents = ""
-        for item in contents:
-            if item[0] == "_content":
-                try:
-                    current_contents += item[1]
-                except Exception:
-                    error(f"Error merging content '{item[1]}' for '{file}'")
-            else:
-                new_contents.append(("_content", current_contents))
-                current_contents = ""
-        if current_contents:
-            new_contents.append(("_content", current_contents))
-        return new_contents
-
-
-    def process_markdown(file, contents):
-        new_contents = []
-        file = file[:-3] + ".html"
-        for item in contents:
-            if item[0] == "_content":
-                try:
-                    new_contents.append(
-                        ("_content", markdown.markdown(item[1], extensions=md_extensions))
-                    )
-                except Exception:
-                    error(f"Error error converting markdown '{item[1]}' for '{file}'")
-            else:
-                new_contents.append(item)
-        return file, new_contents
+                    f"Invalid use of 'this' in '{file}'. Need to have exactly one '.'"
+                )
+            parsed_content.append(("use", var_tree[1]))
+        elif var.startswith("_global"):
+            if len(var_tree) != 2:
+                error(
+                    f"Invalid use of '_global' in '{file}'. Need to have exactly one '.'"
+                )
+            parsed_content.append(("global", var_tree[1]))
+        curr = match.end()
+    if curr < len(content):
+        parsed_content.append(content[curr:])
+    return parsed_content
+
+
+def build_loop_index(variables):
+    """Index the pages with defs for for loops: their names sorted for prefix
+    lookups, each with its position in variables to keep the page order"""
+    return sorted((file, i) for i, file in enumerate(variables))
 
 
-    def process_ipynb(file, contents):
-        new_contents = []
-        file = file[:-6] + ".html"
-        for item in contents:
-            if item[0] == "_content":
+def loop_items(context, file, source):
+    """Returns the def variables of the pages a for loop over `source` goes
+    through, sorted as asked. Results are memoized per (directory, sort key,
+    direction) and shared by every loop asking for the same view, they must
+    not be modified"""
+    root, sort_key, reversed, _ = parse_loop_source(source)
+    # every page of a paginated loop shares the same sorted items
+    key = (root, sort_key, reversed)
+    if key in context["loops"]:
+        return context["loops"][key]
+    index = context["loop_index"]
+    start = bisect.bisect_left(index, (root,))
+    end = start
+    while end < len(index) and index[end][0].startswith(root):
+        end += 1
+    matched = sorted(index[start:end], key=lambda x: x[1])
+    items = [context["variables"][page] for page, _ in matched]
+    if sort_key:
+        try:
+            items = sorted(items, key=lambda x: x[sort_key], reverse=reversed)
+        except KeyError:
+            error(f"Cannot sort by '{sort_key}' in for loop in '{file}', not every page defines it")
+    context["loops"][key] = items
+    return items
+
+
+def for_processor(context, file, node):
+    """Expand a for loop into the list of pieces it renders to"""
+    pieces = []
+    loop_vars = []
+    # thing
+    loop_var = node.args[0].strip()
+    # in
+    if node.args[1] != "in":
+        error(f"Syntax error in for loop for '{file}'")
+    # variable
+    if node.args[2].startswith("_"):
+        loop_vars = loop_items(context, file, node.args[2])
+        per_page = parse_loop_source(node.args[2])[3]
+        if per_page is not None:
+            number = context["shards"][file][1]
+            loop_vars = loop_vars[(number - 1) * int(per_page):number * int(per_page)]
+    # content
+    parsed_content = parse_loop_content(file, loop_var, " ".join(node.args[3:]))
+    # put in the contents
+    for v in loop_vars:
+        for i in parsed_content:
+            if isinstance(i, str):
+                pieces.append(i)
+            elif i[0] == "loop_var":
                 try:
-                    new_contents.append(
-                        ("_content", markdown.markdown(item[1], extensions=md_extensions))
-                    )
+                    pieces.append(reduce(operator.getitem, i[1], v))
                 except Exception:
-                    error(f"Error error converting markdown '{item[1]}' for '{file}'")
+                    error(
+                        f"Cannot find a key in the loop variable of for loop in '{file}'"
+                    )
+            elif i[0] == "use":
+                pieces.append(use_value(context, file, i[1]))
             else:
-                new_contents.append(item)
-        return file, new_contents
-
-
-    def for_processor(file, contents):
-        new_contents = []
-        loop_var = ""
-        loop_vars = []
-        for item in contents:
-            if item[0] == "for":
-                sort_key = None
-                reversed = False
-                # thing
-                loop_var = item[1].strip()
-                # in
-                if item[2] != "in":
-                    error(f"Syntax error in for loop for '{file}'")
-                # variable
-                if item[3].startswith("_"):
-                    if item[3].find("sort(") != -1:
-                        opening = item[3].find("(")
-                        closing = item[3].rfind(")")
-                        starting = item[3].find(",")
-                        sort_key = item[3][starting + 1:closing].strip()
-                        if item[3].find("rsort(") != -1:
-                            reversed = True
-                        root = item[3][opening + 1:starting].strip()
-                    else:
-                        root = item[3].strip()
-                    for i, v in variables.items():
-                        if i.startswith(root):
-                            loop_vars.append(v)
-                # content
-                content = " ".join(item[4:])
-                # loop
-                # parse out the contents
-                regex = r"\{\$(.*?)\$\}"
-                parsed_content = []
-                curr = 0
-                for match in re.finditer(regex, content):
-                    var = match.group(1).strip()
-                    parsed_content.append(
-                        ("_content", content[curr: match.start()]))
-                    var_tree = var.split(".")
-                    if var.startswith(loop_var):
-                        parsed_content.append(("loop_var", var_tree[1:]))
-                    elif var.startswith("this"):
-                        if len(var_tree) != 2:
-                            error(
-                                f"Invalid use of 'this' in '{file}'. Need to have exactly one '.'"
-                            )
-                        parsed_content.append(("use", var_tree[1]))
-                    elif var.startswith("_global"):
-                        if len(var_tree) != 2:
-                            error(
-                                f"Invalid use of '_global' in '{file}'. Need to have exactly one '.'"
-                            )
-                        parsed_content.append(("global", var_tree[1]))
-                    curr = match.end()
-                if curr < len(content):
-                    parsed_content.append(("_content", content[curr:]))
-                # put in the contents
-                if sort_key:
-                    loop_vars = sorted(
-                        loop_vars,
-                        key=lambda x: x[sort_key],
-                        reverse=reversed)
-                for v in loop_vars:
-                    for i in parsed_content:
-                        if i[0] == "loop_var":
-                            try:
-                                new_contents.append(
-                                    ("_content", reduce(
-                                        operator.getitem, i[1], v))
-                                )
-                            except Exception:
-                                error(
-                                    f"Cannot find a key in the loop variable of for loop in '{file}'"
-                                )
-                        else:
-                            new_contents.append(i)
-                if not loop_vars:
-                    new_contents += parsed_content
+                pieces.append(global_value(context, file, i[1]))
+    if not loop_vars:
+        for i in parsed_content:
+            if isinstance(i, str):
+                pieces.append(i)
+            elif i[0] == "use":
+                pieces.append(use_value(context, file, i[1]))
+            elif i[0] == "global":
+                pieces.append(global_value(context, file, i[1]))
             else:
-                new_contents.append(item)
-        return new_contents
+                pieces.append(Tag(*i))
+    return pieces
 
-    # markdown
-    for file, contents in data["pages"].copy().items():
-        if file.endswith(".md"):
-            del data["pages"][file]
-            file, contents = process_markdown(file, contents)
-            data["pages"][file] = contents
-    for file, contents in data["templates"].copy().items():
-        if file.endswith(".md"):
-            error("You cannot have markdown templates")
 
-    # ipynb
+def prepare_pages(data, only=None):
+    """Do the work shared by every page: read the defs of all pages and
+    compile the templates. Returns the context pages are rendered with and
+    the set of markdown pages"""
+    variables = {}
+    context = {
+        "variables": variables,
+        "globals": data["_globals"],
+        "cache_dir": data["_cache_dir"],
+        "profile": profile_events is not None,
+        "search": search_settings(data["_globals"]),
+    }
+
+    # markdown and ipynb pages take their html names before defs are read
+    # so that slugs point to the written files
+    markdown_pages = set()
     for file, contents in data["pages"].copy().items():
-        if file.endswith(".ipynb"):
+        if file.endswith(".md") or file.endswith(".ipynb"):
             del data["pages"][file]
-            file, contents = process_ipynb(file, contents)
+            file = output_name(file)
             data["pages"][file] = contents
+            markdown_pages.add(file)
     for file, contents in data["templates"].copy().items():
         if file.endswith(".md"):
             error("You cannot have markdown templates")
 
     # def
     for file, contents in data["pages"].items():
-        data["pages"][file] = def_processor(file, contents)
+        def_processor(variables, file, contents)
     for file, contents in data["templates"].items():
-        def_processor(file, contents, True)
+        def_processor(variables, file, contents, True)
 
-    # for loops
-    for file, contents in data["pages"].items():
-        data["pages"][file] = for_processor(file, contents)
+    context["loop_index"] = build_loop_index(variables)
+    context["loops"] = {}
 
-    # globals
-    for file, contents in data["pages"].items():
-        data["pages"][file] = globals_processor(file, contents)
-    for file, contents in data["templates"].items():
-        data["templates"][file] = globals_processor(file, contents)
+    # pages with a paginated loop are rendered once per page of the loop,
+    # each with its number and links to the previous and next ones
+    context["shards"] = {}
+    for file, contents in list(data["pages"].items()):
+        loop = paginated_loop(file, contents)
+        if loop is None:
+            continue
+        count = shard_count(len(loop_items(context, file, loop[0])), loop[1])
+        slugs = ["/" + shard_name(file, number).replace("\\", "/") for number in range(1, count + 1)]
+        for number in range(1, count + 1):
+            shard = shard_name(file, number)
+            data["pages"][shard] = contents
+            variables[shard] = dict(variables.get(file, {}))
+            variables[shard].update({
+                "_slug": slugs[number - 1],
+                "_page": str(number),
+                "_pages": str(count),
+                "_prev": slugs[number - 2] if number > 1 else "",
+                "_next": slugs[number] if number < count else "",
+            })
+            context["shards"][shard] = (file, number)
+            if file in markdown_pages:
+                markdown_pages.add(shard)
 
-    # use
-    for file, contents in data["pages"].items():
-        data["pages"][file] = use_processor(file, contents)
-    for file, contents in data["templates"].items():
-        use_processor(file, contents, True)
+    # every page's defs are known now, drop the ones not being rendered
+    if only is not None:
+        for file in list(data["pages"]):
+            if file not in only:
+                del data["pages"][file]
 
-    # expand
+    # sort the loops of the rendered pages once, so pool workers share them
     for file, contents in data["pages"].items():
-        data["pages"][file] = expand_processor(file, contents)
-    for file, contents in data["templates"].items():
-        data["templates"][file] = expand_processor(file, contents)
+        for node in contents:
+            if node.name == "for" and len(node.args) > 2 and node.args[2].startswith("_"):
+                loop_items(context, file, node.args[2])
 
-    # template
-    for file, contents in data["templates"].items():
-        data["templates"][file] = template_processor(file, contents, True)
-    for file, contents in data["pages"].items():
-        data["pages"][file] = template_processor(file, contents)
+    context["compiled"] = compile_templates(context, data["templates"])
+    return context, markdown_pages
+
+
+def render_contents(context, file, contents, is_markdown=False, search=None):
+    """Render a page in a single traversal of its nodes and return its html.
+    The page ends at the first tag left over once everything is resolved.
+    If the search index is configured, the page's entry is added to `search`"""
+    with profiled(file, "render"):
+        return render_nodes(context, file, contents, is_markdown, search)
+
+
+def render_nodes(context, file, contents, is_markdown, search):
+    pieces = []
+    template = None
+    for node in contents:
+        name = node.name
+        if name == "_content":
+            if is_markdown:
+                pieces.append(convert_markdown(file, node.text, context["cache_dir"]))
+            else:
+                pieces.append(node.text)
+        elif name == "def":
+            continue
+        elif name == "for":
+            pieces += for_processor(context, file, node)
+        elif name == "global":
+            pieces.append(global_value(context, file, node.args[0]))
+        elif name == "use":
+            pieces.append(use_value(context, file, node.args[0]))
+        elif name == "expand":
+            try:
+                pieces += context["compiled"][node.args[0]]["pieces"]
+            except Exception:
+                error(f"Error expanding template '{node.args[0]}' for '{file}'")
+        elif name == "template":
+            if template:
+                error(
+                    f"You cannot have more than one template declarations inside '{file}'"
+                )
+            template = node
+        else:
+            pieces.append(node)
+
+    # the page's own content, without what its template adds around it
+    if search is not None and context["search"]:
+        entry = search_entry(
+            context["search"], context["variables"].get(file, {}), file, pieces)
+        if entry:
+            search[file] = entry
+
+    parts = (pieces,)
+    template_props = ()
+    if template:
+        try:
+            compiled = context["compiled"][template.args[0]]
+        except Exception:
+            if file.endswith(".html"):
+                file = file[:-5]
+            error(
+                f"Cannot find template '{template.args[0]}' for file '{file}'")
+        if compiled["before"] is not None:
+            parts = (compiled["before"], pieces, compiled["after"])
+        template_props = set(template.args[1:])
+
+    out = []
+    for part in parts:
+        for piece in part:
+            if isinstance(piece, Tag):
+                if not (template and piece.name == "prop"):
+                    return "".join(out)
+                if piece.args[0] not in template_props:
+                    error(
+                        f"Prop '{piece.args[0]}' not passed to the page '{template.args[0]}'"
+                    )
+                piece = use_value(context, file, piece.args[0])
+            if not isinstance(piece, str):
+                error(f"Error merging content '{piece}' for '{file}'")
+            out.append(piece)
+    return "".join(out)
 
-    # _content
-    for file, contents in data["pages"].items():
-        data["pages"][file] = content_processor(file, contents)
+
+worker_context = None
+
+
+def init_worker(context):
+    """Keep the shared rendering context around in a pool worker"""
+    global worker_context
+    worker_context = context
+    init_profiling(context["profile"])
+
+
+def render_in_worker(task):
+    """Render a (file, contents, is_markdown) task inside a pool worker.
+    Returns the html, the page's search entry (or None) and the trace events
+    recorded while rendering"""
+    file, contents, is_markdown = task
+    search = {}
+    html = render_contents(worker_context, file, contents, is_markdown, search)
+    return html, search.get(file), take_profile_events()
+
+
+def process_pages(data, only=None, jobs=1):
+    """Parse pages and templates directory to create final files. If `only`
+    is given, the rest of the pages are dropped once their defs are read.
+    With more than one job, pages are rendered on a process pool"""
+    with profiled("prepare_pages"):
+        context, markdown_pages = prepare_pages(data, only)
+    tasks = [
+        (file, contents, file in markdown_pages)
+        for file, contents in data["pages"].items()
+    ]
+    if jobs == 1 or len(tasks) < 2:
+        for task in tasks:
+            data["pages"][task[0]] = render_contents(context, *task, data["search"])
+        return
+    chunksize = max(1, len(tasks) // (jobs * 4))
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(
+        max_workers=jobs, initializer=init_worker, initargs=(context,)
+    ) as executor:
+        results = executor.map(render_in_worker, tasks, chunksize=chunksize)
+        for task, (contents, entry, events) in zip(tasks, results):
+            data["pages"][task[0]] = contents
+            if entry:
+                data["search"][task[0]] = entry
+            if profile_events is not None:
+                profile_events.extend(events)
+
+
+def stream_pages(data, only=None, weigh=False):
+    """Render, write and minify pages one at a time. `data` holds light
+    trees from a first pass, enough for defs, loops and templates, and each
+    page is read in full again right before it is rendered so only one page
+    is in memory at a time. If `only` is given, just those pages are built.
+    Returns the number of cache hits, misses and bytes saved by minifying,
+    the variants made of each image and the weights of the pages if `weigh`"""
+    sources = {output_name(file): file for file in data["pages"]}
+    context, markdown_pages = prepare_pages(data, only)
+    pages_dir = os.path.join(data["_input_dir"], "pages")
+    settings = image_settings(data["_globals"])
+    stats = {"hits": 0, "misses": 0, "saved": 0, "variants": {}, "weights": {}}
+    for file in list(data["pages"]):
+        assets = {}
+        source = sources[context["shards"][file][0] if file in context["shards"] else file]
+        contents = get_file_tree(
+            os.path.join(pages_dir, source), source, assets,
+            notebook_settings(data["_globals"]))
+        contents = render_contents(
+            context, file, contents, file in markdown_pages, data["search"])
+        # the light tree is no longer needed either
+        data["pages"][file] = None
+        write_page(data["_output_dir"], file, contents)
+        write_assets(data, None, assets)
+        for path in [file, *assets]:
+            result = minify_file(
+                os.path.join(data["_output_dir"], path), data["_cache_dir"], settings,
+                path.replace("\\", "/") if weigh else None)
+            if result:
+                hit, before, after, weight, variants = result
+                stats["hits" if hit else "misses"] += 1
+                stats["saved"] += before - after
+                if is_image(path):
+                    name = path.replace("\\", "/")
+                    stats["variants"][name] = [
+                        posixpath.join(posixpath.dirname(name), variant) for variant in variants]
+                if weight is not None:
+                    stats["weights"][path.replace("\\", "/")] = weight
+    message(
+        f"Minified {stats['hits'] + stats['misses']} pages and assets: {stats['hits']} cache hits, "
+        f"{stats['misses']} misses, {stats['saved']} bytes saved"
+    )
+    return stats
 
 
 def write_files(data):
-    """Write the files of pages into the output directory
-    assuming there is only one _content block for all pages"""
+    """Write the rendered pages into the output directory"""
     for file_path, contents in data["pages"].items():
+        write_page(data["_output_dir"], file_path, contents)
+
+
+def write_page(output_dir, file_path, contents):
+    """Write a single rendered page into the output directory"""
+    message(f"Writing: {file_path}")
+    with profiled(file_path, "write"):
+        write_page_file(output_dir, file_path, contents)
+
+
+def write_page_file(output_dir, file_path, contents):
+    if ("/" in file_path) or ("\\" in file_path):
+        head, tail = os.path.split(file_path)
+        base_path = os.path.join(output_dir, head)
+        file_path = tail
+        os.makedirs(base_path, exist_ok=True)
+    else:
+        base_path = output_dir
+    with open(os.path.join(base_path, file_path), "w", encoding="utf-8") as file:
+        file.write(contents)
+
+
+def write_assets(data, only=None, assets=None):
+    """Write the images extracted from notebooks into the output directory.
+    If `only` is given, just those assets are written. `assets` defaults to
+    the ones in data"""
+    if assets is None:
+        assets = data["assets"]
+    for file_path, asset in assets.items():
+        if only is not None and file_path not in only:
+            continue
         message(f"Writing: {file_path}")
-        contents = contents[0][1]
-        if ("/" in file_path) or ("\\" in file_path):
-            head, tail = os.path.split(file_path)
-            base_path = os.path.join(data["_output_dir"], head)
-            file_path = tail
-            os.makedirs(base_path, exist_ok=True)
+        output_path = os.path.join(data["_output_dir"], file_path)
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        with open(output_path, "wb") as file:
+            file.write(asset["contents"])
+
+
+def search_settings(globals):
+    """Reads the `_search` section of config.yml, None if there is none"""
+    if "_search" not in (globals or {}):
+        return None
+    settings = globals["_search"] or {}
+    return {
+        "dir": str(settings.get("dir", "search")).strip("/"),
+        "fields": [str(field) for field in settings.get("fields", ["title"])],
+        "exclude": [str(path).lstrip("/") for path in settings.get("exclude", [])],
+        "prefix": max(1, int(settings.get("prefix", 2))),
+        "min_length": max(1, int(settings.get("min_length", 2))),
+        "max_terms": int(settings.get("max_terms", 500)),
+    }
+
+
+def search_terms(text, settings):
+    """Returns the words of a text, lowercased, long enough to be indexed"""
+    return [
+        term for term in re.findall(r"\w+", text.lower())
+        if len(term) >= settings["min_length"]
+    ]
+
+
+def search_entry(settings, variables, file, pieces):
+    """Returns the search index entry of a page from its own rendered pieces:
+    the values of the indexed defs and how often each term appears, defs
+    counting five times. None if the page is not indexed"""
+    if not file.endswith(".html") or any(
+        file.replace("\\", "/").startswith(path) for path in settings["exclude"]
+    ):
+        return None
+    text = "".join(piece for piece in pieces if isinstance(piece, str))
+    text = re.sub(r"<(script|style)\b.*?</\1\s*>", " ", text, flags=re.S | re.I)
+    text = unescape(re.sub(r"<[^>]*>", " ", text))
+    counts = {}
+    for term in search_terms(text, settings):
+        counts[term] = counts.get(term, 0) + 1
+    fields = [str(variables.get(field, "")) for field in settings["fields"]]
+    for value in fields:
+        for term in search_terms(value, settings):
+            counts[term] = counts.get(term, 0) + 5
+    # keep the page's most frequent terms
+    if len(counts) > settings["max_terms"]:
+        kept = sorted(counts.items(), key=lambda x: (-x[1], x[0]))[:settings["max_terms"]]
+        counts = dict(kept)
+    return {"fields": fields, "terms": counts}
+
+
+def search_shard(term, settings):
+    """Name of the index shard a term is in, its prefix as is. Terms are
+    lowercased word characters, safe in file names, and servers decode the
+    percent-encoded URL a browser asks for back to them"""
+    return term[:settings["prefix"]]
+
+
+def load_search_index(output_dir, settings, keep=None):
+    """Read back the entries of the pages in `keep` (all if None) from the
+    search index of a previous build, returns a dict of page -> entry"""
+    index_dir = os.path.join(output_dir, settings["dir"])
+    try:
+        with open(os.path.join(index_dir, "index.json"), "r", encoding="utf-8") as f:
+            docs = json.load(f)["docs"]
+    except (OSError, ValueError, KeyError):
+        return {}
+    entries = {}
+    for doc in docs:
+        if keep is None or doc[0].lstrip("/") in keep:
+            entries[doc[0].lstrip("/")] = {"fields": doc[1:], "terms": {}}
+    shards_dir = os.path.join(index_dir, "shards")
+    for name in os.listdir(shards_dir) if os.path.isdir(shards_dir) else []:
+        if not name.endswith(".json"):
+            continue
+        with open(os.path.join(shards_dir, name), "r", encoding="utf-8") as f:
+            shard = json.load(f)
+        for term, postings in shard.items():
+            for i in range(0, len(postings), 2):
+                page = docs[postings[i]][0].lstrip("/")
+                if page in entries:
+                    entries[page]["terms"][term] = postings[i + 1]
+    return entries
+
+
+def write_search_index(data, keep=None):
+    """Write the search index of the rendered pages, sharded by term prefix,
+    so browsers only download the shards of the terms searched for. Pages in
+    `keep` were not rendered again and keep their entries from the previous
+    build. Returns the written files relative to the output dir"""
+    settings = search_settings(data["_globals"])
+    if settings is None:
+        return []
+    message("Writing search index...")
+    entries = {}
+    if keep:
+        entries = load_search_index(data["_output_dir"], settings, keep)
+    entries.update(data["search"])
+    pages = sorted(entries)
+    shards = {}
+    for doc, page in enumerate(pages):
+        for term, count in entries[page]["terms"].items():
+            shards.setdefault(search_shard(term, settings), {}).setdefault(term, []).append((count, doc))
+
+    index_dir = os.path.join(data["_output_dir"], settings["dir"])
+    shards_dir = os.path.join(index_dir, "shards")
+    os.makedirs(shards_dir, exist_ok=True)
+    written = []
+
+    def dump(name, value):
+        with open(os.path.join(index_dir, name), "w", encoding="utf-8") as f:
+            json.dump(value, f, ensure_ascii=False, separators=(",", ":"))
+        written.append(f"{settings['dir']}/{name}")
+
+    dump("index.json", {
+        "fields": settings["fields"],
+        "prefix": settings["prefix"],
+        "min_length": settings["min_length"],
+        "docs": [["/" + page.replace("\\", "/")] + entries[page]["fields"] for page in pages],
+    })
+    for name, terms in shards.items():
+        # postings are flat [doc, count, doc, count...], best matches first
+        dump(f"shards/{name}.json", {
+            term: [x for count, doc in sorted(postings, key=lambda p: (-p[0], p[1])) for x in (doc, count)]
+            for term, postings in sorted(terms.items())
+        })
+    for name in os.listdir(shards_dir):
+        if name.endswith(".json") and f"{settings['dir']}/shards/{name}" not in written:
+            os.remove(os.path.join(shards_dir, name))
+            if os.path.exists(os.path.join(shards_dir, name + ".gz")):
+                os.remove(os.path.join(shards_dir, name + ".gz"))
+    return written
+
+
+def is_text_asset(file_path):
+    """Whether the file is minified as HTML, CSS or JS"""
+    return (
+        file_path.endswith(".html")
+        or file_path.endswith(".css")
+        or file_path.endswith(".js")
+    )
+
+
+def is_image(file_path):
+    """Whether the file is optimized as an image"""
+    return (
+        file_path.lower().endswith(".png")
+        or file_path.lower().endswith(".jpg")
+        or file_path.lower().endswith(".jpeg")
+    )
+
+
+def strip_image(pic):
+    """Returns a copy of the image without its metadata. The pixel buffer is
+    copied as a whole, only palette transparency is kept"""
+    stripped = pic.copy()
+    stripped.info = {
+        key: value for key, value in pic.info.items() if key == "transparency"
+    }
+    return stripped
+
+
+def image_settings(globals):
+    """Reads the `_images` section of config.yml"""
+    settings = (globals or {}).get("_images") or {}
+    return {
+        "widths": sorted({int(width) for width in settings.get("widths", [])}),
+        "webp": bool(settings.get("webp", False)),
+        "webp_quality": int(settings.get("webp_quality", 80)),
+    }
+
+
+def image_variants(file_path, width, settings):
+    """Returns (path, width, format) of every variant made of an image that is
+    `width` pixels wide. Variants are never wider than the image, a width of
+    None keeps the original size and a format of None keeps the original one"""
+    root, ext = os.path.splitext(file_path)
+    variants = []
+    if not settings:
+        return variants
+    for variant_width in [None] + [w for w in settings["widths"] if w < width]:
+        size = f"-{variant_width}w" if variant_width else ""
+        if variant_width:
+            variants.append((f"{root}{size}{ext}", variant_width, None))
+        if settings["webp"]:
+            variants.append((f"{root}{size}.webp", variant_width, "WEBP"))
+    return variants
+
+
+def encode_image(pic, format, quality=95):
+    """Returns the image encoded in the given format"""
+    out = io.BytesIO()
+    if format == "WEBP":
+        if pic.mode not in ("RGB", "RGBA"):
+            has_alpha = "A" in pic.mode or "transparency" in pic.info
+            pic = pic.convert("RGBA" if has_alpha else "RGB")
+        pic.save(out, format=format, quality=quality)
+    elif format == "JPEG":
+        pic.save(out, format=format, optimize=True, quality=quality)
+    else:
+        pic.save(out, format=format, optimize=True)
+    return out.getvalue()
+
+
+def optimize_image(file_path, contents, settings=None):
+    """Strip the metadata of an image and make its configured variants.
+    Returns a dict of output path -> contents"""
+    from PIL import Image
+
+    pic = Image.open(io.BytesIO(contents))
+    # camera JPEGs with extra frames open as MPO, save them as the JPEG they are
+    format = "JPEG" if pic.format == "MPO" else pic.format
+    stripped = strip_image(pic)
+    outputs = {file_path: encode_image(stripped, format)}
+    for path, width, variant_format in image_variants(file_path, pic.width, settings):
+        variant = stripped
+        if width:
+            if variant.mode not in ("1", "L", "RGB", "RGBA", "CMYK"):
+                variant = variant.convert("RGBA")
+            height = max(1, round(pic.height * width / pic.width))
+            variant = variant.resize((width, height), Image.LANCZOS)
+        if variant_format:
+            outputs[path] = encode_image(variant, variant_format, settings["webp_quality"])
         else:
-            base_path = data["_output_dir"]
-        with open(os.path.join(base_path, file_path), "w", encoding="utf-8") as file:
-            file.write(contents)
+            outputs[path] = encode_image(variant, format)
+    return outputs
 
 
-def minify(output_dir):
-    """Minify HTML, CSS, JS and image files present in output directory"""
+def minify_outputs(file_path, contents, settings=None):
+    """Minify the contents of an HTML, CSS, JS or image file in memory.
+    Returns a dict of output path -> contents, images may come with variants"""
+    if is_text_asset(file_path):
+        import minify_html_onepass
+
+        text = contents.decode("utf-8").replace("\r\n", "\n").replace("\r", "\n")
+        return {
+            file_path: minify_html_onepass.minify(text, minify_js=True).encode("utf-8")
+        }
+    if is_image(file_path):
+        return optimize_image(file_path, contents, settings)
+    return {file_path: contents}
+
+
+def minify_bytes(file_path, contents):
+    """Minify the contents of an HTML, CSS, JS or image file in memory"""
+    return minify_outputs(file_path, contents)[file_path]
+
+
+def minify_output_paths(file_path, contents, settings=None):
+    """Returns the paths minify_outputs would produce without encoding anything"""
+    if not is_image(file_path) or not settings:
+        return [file_path]
+    from PIL import Image
+
+    width = Image.open(io.BytesIO(contents)).width
+    return [file_path] + [
+        path for path, _, _ in image_variants(file_path, width, settings)
+    ]
+
+
+def minify_cache_key(file_path, contents, settings=None):
+    """Cache key of a file's minified contents, covering the minifier versions
+    and image settings"""
+    key = hashlib.sha256()
+    kind = "text" if is_text_asset(file_path) else f"image:{settings}"
+    key.update(
+        f"{minify_cache_version}:{kind}:{library_version('minify_html_onepass')}:{library_version('Pillow')};"
+        .encode("utf-8")
+    )
+    key.update(contents)
+    return key.hexdigest()
+
+
+def minify_file(file_path, cache_dir=None, settings=None, page=None):
+    """Minify a single HTML, CSS, JS or image file in place, writing image
+    variants next to it. Files seen before are restored from the cache.
+    Returns (cache hit, size before, size after, weight, variants) or None if
+    the file is not minifiable. The weight is only taken for pages, when
+    `page` is the name of the file relative to output dir, and variants are
+    the names of the image variants written next to the file"""
+    if not (is_text_asset(file_path) or is_image(file_path)):
+        return None
+    with profiled(file_path, "image" if is_image(file_path) else "minify"):
+        return minify_file_contents(file_path, cache_dir, settings, page)
+
+
+def minify_file_contents(file_path, cache_dir, settings, page):
+    with open(file_path, "rb") as f:
+        contents = f.read()
+    root = os.path.splitext(file_path)[0]
+    outputs = None
+    cache_paths = {}
+    if cache_dir:
+        key = minify_cache_key(file_path, contents, settings)
+        base = os.path.join(cache_dir, "minify", key[:2], key)
+        cache_paths = {
+            path: base + path[len(root):]
+            for path in minify_output_paths(file_path, contents, settings)
+        }
+        if all(os.path.exists(path) for path in cache_paths.values()):
+            outputs = {}
+            for path, cache_path in cache_paths.items():
+                with open(cache_path, "rb") as f:
+                    outputs[path] = f.read()
+    hit = outputs is not None
+    if not hit:
+        outputs = minify_outputs(file_path, contents, settings)
+        for path, cache_path in cache_paths.items():
+            write_cache(cache_path, outputs[path])
+    for path, minified in outputs.items():
+        if path == file_path and minified == contents:
+            continue
+        # public files may be hardlinked to their sources
+        replace_file(path, minified)
+    weight = None
+    if page is not None and file_path.endswith(".html"):
+        weight = page_weight(page, len(contents), outputs[file_path])
+    variants = sorted(os.path.basename(path) for path in outputs if path != file_path)
+    return hit, len(contents), len(outputs[file_path]), weight, variants
+
+
+def minify_task(task):
+    """Minify a (file path, cache dir, image settings, page) task inside a
+    pool worker. Returns the result and the trace events recorded meanwhile"""
+    return minify_file(*task), take_profile_events()
+
+
+def minify(output_dir, only=None, jobs=1, cache_dir=None, settings=None, weigh=False):
+    """Minify HTML, CSS, JS and image files present in output directory and
+    make the image variants given by `settings`. If `only` is given, just those
+    files relative to output dir are minified. Returns the number of cache
+    hits, misses and bytes saved, the variants made of each image and the
+    weights of the pages if `weigh`"""
     message("Minifiying files...")
-    for root, _, files in os.walk(output_dir):
-        for file in files:
-            # html, css, js
-            file_path = os.path.join(root, file)
-            if (
-                file_path.endswith(".html")
-                or file_path.endswith(".css")
-                or file_path.endswith(".js")
-            ):
-                with open(file_path, "r", encoding="utf-8") as fl:
-                    contents = "".join(fl.readlines())
-                with open(file_path, "w", encoding="utf-8") as fl:
-                    fl.write(minify_html_onepass.minify(
-                        contents, minify_js=True))
-            # images
-            if (
-                file_path.lower().endswith(".png")
-                or file_path.lower().endswith(".jpg")
-                or file_path.lower().endswith(".jpeg")
+    if only is not None:
+        files = [os.path.join(output_dir, file) for file in only]
+    else:
+        files = [
+            os.path.join(root, file)
+            for root, _, names in os.walk(output_dir) for file in names
+        ]
+    tasks = [
+        (file, cache_dir, settings,
+         leftover_path(output_dir, file).replace(os.sep, "/") if weigh else None)
+        for file in files if is_text_asset(file) or is_image(file)
+    ]
+    stats = {"hits": 0, "misses": 0, "saved": 0, "variants": {}, "weights": {}}
+
+    def collect(results):
+        for task, ((hit, before, after, weight, variants), events) in zip(tasks, results):
+            stats["hits" if hit else "misses"] += 1
+            stats["saved"] += before - after
+            if is_image(task[0]):
+                file = leftover_path(output_dir, task[0]).replace(os.sep, "/")
+                stats["variants"][file] = [
+                    posixpath.join(posixpath.dirname(file), name) for name in variants]
+            if weight is not None:
+                stats["weights"][task[3]] = weight
+            if profile_events is not None:
+                profile_events.extend(events)
+
+    if jobs == 1 or len(tasks) < 2:
+        collect((minify_file(*task), []) for task in tasks)
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(
+            max_workers=jobs,
+            initializer=init_profiling,
+            initargs=(profile_events is not None,),
+        ) as executor:
+            collect(executor.map(
+                minify_task, tasks, chunksize=max(1, len(tasks) // (jobs * 4))))
+    message(
+        f"Minified {len(tasks)} files: {stats['hits']} cache hits, "
+        f"{stats['misses']} misses, {stats['saved']} bytes saved"
+    )
+    return stats
+
+
+def fingerprint_name(file, contents):
+    """Returns name.<hash>.ext for a file with the given contents"""
+    root, ext = os.path.splitext(file)
+    return f"{root}.{hashlib.sha256(contents).hexdigest()[:8]}{ext}"
+
+
+def rewrite_references(text, base, lookup):
+    """Rewrite the URLs in HTML attributes, srcsets and CSS url()s and
+    @imports that point to renamed files. `base` is the directory of the file
+    relative to the output dir and `lookup` returns the new name of a file
+    relative to the output dir, or None. Only the file name of a URL changes"""
+
+    def replace_url(url):
+        path, rest = re.match(r"([^?#]*)(.*)", url, re.S).groups()
+        if not path or path.startswith("//") or re.match(r"[a-zA-Z][a-zA-Z0-9+.-]*:", path):
+            return url
+        target = urllib.parse.unquote(path)
+        if target.startswith("/"):
+            target = target.lstrip("/")
+        else:
+            target = posixpath.join(base, target)
+        new = lookup(posixpath.normpath(target))
+        if new is None:
+            return url
+        name = posixpath.basename(path)
+        return path[:len(path) - len(name)] + urllib.parse.quote(posixpath.basename(new)) + rest
+
+    def replace_value(match, srcset=False):
+        value = match.group(2)
+        quote = value[0] if value[:1] in ("\"", "'") else ""
+        inner = value[len(quote):len(value) - len(quote)]
+        if srcset:
+            inner = ",".join(
+                re.sub(r"^(\s*)(\S+)", lambda m: m.group(1) + replace_url(m.group(2)), candidate)
+                for candidate in inner.split(",")
+            )
+        else:
+            inner = replace_url(inner.strip())
+        return match.group(1) + quote + inner + quote + (match.group(3) if match.lastindex > 2 else "")
+
+    value = r"(\"[^\"]*\"|'[^']*'|[^\s\"'>]+)"
+    text = re.sub(r"(\b(?:src|href|poster|data-src)\s*=\s*)" + value, replace_value, text, flags=re.I)
+    text = re.sub(
+        r"(\bsrcset\s*=\s*)" + value, lambda m: replace_value(m, True), text, flags=re.I)
+    text = re.sub(r"(url\(\s*)(\"[^\"]*\"|'[^']*'|[^)\s]*)(\s*\))", replace_value, text, flags=re.I)
+    text = re.sub(r"(@import\s+)(\"[^\"]*\"|'[^']*')", replace_value, text, flags=re.I)
+    return text
+
+
+def fingerprint(output_dir, only=None, pages=None, removed=(), skip=(), settings=None):
+    """Copy CSS, JS, images and fonts in the output directory to
+    name.<hash>.ext, hashing their final (minified) bytes, and rewrite the
+    references to them in pages and CSS. The originals are kept. `only` are the files written by this
+    build and `pages` the pages rendered, everything if None, and `skip` are
+    files never renamed. The map of names is kept in fingerprints.json, which
+    lets incremental builds rename what changed and update the references
+    to it. Returns the files written, relative to output dir"""
+    message("Fingerprinting files...")
+    manifest_path = os.path.join(output_dir, fingerprint_file)
+    previous = {}
+    if only is not None and os.path.exists(manifest_path):
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            previous = json.load(f)
+    else:
+        # everything is renamed the first time
+        only = pages = None
+    if only is None:
+        only = [
+            leftover_path(output_dir, os.path.join(root, name)).replace(os.sep, "/")
+            for root, _, names in os.walk(output_dir) for name in names
+        ]
+    else:
+        only = set(only) | {
+            path for file in only if is_image(file)
+            for path, _, _ in image_variants(file, float("inf"), settings)
+        }
+    candidates = sorted(
+        file for file in only
+        if file.endswith(fingerprint_extensions) and file not in skip
+        and os.path.exists(os.path.join(output_dir, file))
+    )
+    reverse = {new: file for file, new in previous.items()}
+    mapping = {
+        file: new for file, new in previous.items()
+        if file not in removed and file not in candidates
+    }
+    written = []
+
+    def lookup(target):
+        if target in mapping:
+            return mapping[target]
+        # names given by earlier builds, back to the original if it is gone
+        if target in reverse:
+            return mapping.get(reverse[target], reverse[target])
+        return None
+
+    def rename(file, source, contents):
+        new = fingerprint_name(file, contents)
+        if source != new:
+            replace_file(os.path.join(output_dir, new), contents)
+            # originals stay for the references that are not rewritten, like
+            # og:image metas, web manifests and URLs in JS
+            if source != file:
+                os.remove(os.path.join(output_dir, source))
+            written.append(new)
+        mapping[file] = new
+
+    for file in candidates:
+        if not file.endswith(".css"):
+            with open(os.path.join(output_dir, file), "rb") as f:
+                rename(file, file, f.read())
+    # stylesheets of earlier builds may point to files renamed just now
+    stylesheets = {file: file for file in candidates if file.endswith(".css")}
+    if mapping != previous:
+        for file, new in previous.items():
+            if file.endswith(".css") and file in mapping:
+                stylesheets[file] = mapping.pop(file)
+    pending = {}
+    for file, source in stylesheets.items():
+        with open(os.path.join(output_dir, source), "r", encoding="utf-8") as f:
+            pending[file] = (source, f.read())
+    # rewrite stylesheets after the ones they @import, cycles in any order
+    imports = {}
+    for file, (source, text) in pending.items():
+        targets = set()
+        rewrite_references(text, posixpath.dirname(file), targets.add)
+        imports[file] = {
+            other for other in pending
+            if other != file and {other, pending[other][0]} & targets
+        }
+    while pending:
+        ready = [file for file in pending if not imports[file] & pending.keys()] or list(pending)
+        for file in ready:
+            source, text = pending.pop(file)
+            rewritten = rewrite_references(text, posixpath.dirname(file), lookup)
+            rename(file, source, rewritten.encode("utf-8"))
+
+    # files renamed by earlier builds that are gone or renamed again
+    for file, new in previous.items():
+        if mapping.get(file) != new:
+            for path in (new, new + ".gz"):
+                if os.path.exists(os.path.join(output_dir, path)):
+                    os.remove(os.path.join(output_dir, path))
+
+    if pages is None or mapping != previous:
+        pages = [
+            leftover_path(output_dir, os.path.join(root, name)).replace(os.sep, "/")
+            for root, _, names in os.walk(output_dir) for name in names
+        ]
+    for page in pages:
+        if not page.endswith(".html"):
+            continue
+        page_path = os.path.join(output_dir, page)
+        with open(page_path, "r", encoding="utf-8") as f:
+            text = f.read()
+        rewritten = rewrite_references(text, posixpath.dirname(page), lookup)
+        if rewritten != text:
+            with open(page_path, "w", encoding="utf-8") as f:
+                f.write(rewritten)
+            written.append(page)
+
+    with open(manifest_path, "w", encoding="utf-8") as f:
+        json.dump(mapping, f, indent=1, sort_keys=True)
+    written.append(fingerprint_file)
+    message(f"Fingerprinted {len(mapping)} files, {len(written)} files written")
+    return written
+
+
+def gzip_file(file_path, min_size, known_hash=None):
+    """Write a maximum level gzip sidecar next to a file. The sidecar is left
+    alone if the file still has `known_hash`, and removed if the file got
+    smaller than `min_size`. Returns (hash, size, compressed size or None if
+    skipped) or None if the file is too small"""
+    with open(file_path, "rb") as f:
+        contents = f.read()
+    sidecar = file_path + ".gz"
+    if len(contents) < min_size:
+        if os.path.exists(sidecar):
+            os.remove(sidecar)
+        return None
+    content_hash = hashlib.sha256(contents).hexdigest()
+    if content_hash == known_hash and os.path.exists(sidecar):
+        return content_hash, len(contents), None
+    with profiled(file_path, "gzip"):
+        # no timestamp in the header so the same file compresses the same
+        compressed = gzip.compress(contents, compresslevel=9, mtime=0)
+        with open(sidecar, "wb") as f:
+            f.write(compressed)
+    return content_hash, len(contents), len(compressed)
+
+
+def gzip_task(task):
+    """Compress a (file path, min size, known hash) task inside a pool worker.
+    Returns the result and the trace events recorded meanwhile"""
+    return gzip_file(*task), take_profile_events()
+
+
+def gzip_outputs(output_dir, min_size, only=None, jobs=1, compressed=None):
+    """Write gzip sidecars for the HTML, CSS, JS, SVG and JSON files in the
+    output directory, or just the files in `only`. `compressed` maps outputs
+    to their hashes when they were last compressed, those that did not change
+    are skipped. Returns the updated mapping"""
+    message("Compressing files...")
+    compressed = dict(compressed or {})
+    if only is not None:
+        # some outputs may have been renamed by fingerprinting
+        files = [file for file in only if os.path.exists(os.path.join(output_dir, file))]
+    else:
+        files = [
+            os.path.relpath(os.path.join(root, file), output_dir)
+            for root, _, names in os.walk(output_dir) for file in names
+        ]
+    files = [
+        file.replace(os.sep, "/") for file in files
+        if file.endswith(gzip_extensions) and file != manifest_file
+    ]
+    tasks = [
+        (os.path.join(output_dir, file), min_size, compressed.get(file))
+        for file in files
+    ]
+    stats = {"written": 0, "skipped": 0, "saved": 0}
+
+    def collect(results):
+        for file, (result, events) in zip(files, results):
+            if profile_events is not None:
+                profile_events.extend(events)
+            if result is None:
+                compressed.pop(file, None)
+                continue
+            content_hash, before, after = result
+            compressed[file] = content_hash
+            if after is None:
+                stats["skipped"] += 1
+            else:
+                stats["written"] += 1
+                stats["saved"] += before - after
+
+    if jobs == 1 or len(tasks) < 2:
+        collect((gzip_file(*task), []) for task in tasks)
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(
+            max_workers=jobs,
+            initializer=init_profiling,
+            initargs=(profile_events is not None,),
+        ) as executor:
+            collect(executor.map(
+                gzip_task, tasks, chunksize=max(1, len(tasks) // (jobs * 4))))
+    message(
+        f"Compressed {stats['written']} files, {stats['skipped']} unchanged, "
+        f"{stats['saved']} bytes saved"
+    )
+    return compressed
+
+
+def remove_sidecars(output_dir, compressed):
+    """Delete the gzip sidecars recorded by a previous build"""
+    for file in compressed:
+        sidecar = os.path.join(output_dir, file + ".gz")
+        if os.path.exists(sidecar):
+            os.remove(sidecar)
+
+
+def budget_settings(globals):
+    """Reads the `_budgets` section of config.yml, None if there is none"""
+    if "_budgets" not in (globals or {}):
+        return None
+    settings = globals["_budgets"] or {}
+    return {
+        "limits": {key: int(settings[key]) for key in weight_columns if key in settings},
+        "exclude": [str(path).lstrip("/") for path in settings.get("exclude", [])],
+    }
+
+
+def page_weight(page, raw, contents):
+    """Returns the weight of a minified page: its size before and after
+    minifying and gzipped, the bytes of its inline data: URIs and the local
+    CSS, JS, images and fonts it references, relative to output dir"""
+    text = contents.decode("utf-8")
+    targets = set()
+    rewrite_references(text, posixpath.dirname(page), targets.add)
+    # a URI runs to the end of its quoted value or url(), notebook images
+    # have a space after the comma
+    uris = re.findall(
+        r"\"\s*(data:[^\"]*)\"|'\s*(data:[^']*)'|\(\s*(data:[^)\"']*)\)|=(data:[^\s\"'>]*)",
+        text, flags=re.I)
+    return {
+        "raw": raw,
+        "html": len(contents),
+        "gzip": len(gzip.compress(contents, compresslevel=9, mtime=0)),
+        "inline": sum(len("".join(groups).rstrip()) for groups in uris),
+        "references": sorted(target for target in targets if target.endswith(fingerprint_extensions)),
+    }
+
+
+def check_weights(output_dir, weights, settings=None, top=None):
+    """Count and size the files each page references, print the `top`
+    heaviest pages and fail the build if a page is over the budgets in
+    `settings`. References to fingerprinted files are looked up by their
+    original names"""
+    from rich.table import Table
+
+    renamed = {}
+    if os.path.exists(os.path.join(output_dir, fingerprint_file)):
+        with open(os.path.join(output_dir, fingerprint_file), "r", encoding="utf-8") as f:
+            renamed = json.load(f)
+    sizes = {}
+    rows = {}
+    for page, weight in weights.items():
+        row = {key: weight[key] for key in ("raw", "html", "gzip", "inline")}
+        row["assets"] = row["asset_bytes"] = 0
+        for reference in weight["references"]:
+            if reference not in sizes:
+                path = os.path.join(output_dir, renamed.get(reference, reference))
+                sizes[reference] = os.path.getsize(path) if os.path.isfile(path) else None
+            if sizes[reference] is not None:
+                row["assets"] += 1
+                row["asset_bytes"] += sizes[reference]
+        row["total"] = row["html"] + row["asset_bytes"]
+        rows[page] = row
+
+    if top:
+        table = Table(title="Heaviest pages", **table_styles)
+        table.add_column("Page", overflow="fold")
+        columns = {"raw": "Raw", **weight_columns}
+        for title in columns.values():
+            table.add_column(title, justify="right")
+        for page, row in sorted(rows.items(), key=lambda x: (-x[1]["total"], x[0]))[:top]:
+            table.add_row(page, *(str(row[key]) for key in columns))
+        get_console().print(table)
+    if settings is None:
+        return
+    over = [
+        (page, key, row[key], limit)
+        for page, row in sorted(rows.items())
+        if not any(page.startswith(path) for path in settings["exclude"])
+        for key, limit in settings["limits"].items() if row[key] > limit
+    ]
+    if not over:
+        message(f"All {len(rows)} pages are within budget")
+        return
+    table = Table(title="Over budget", **table_styles)
+    table.add_column("Page")
+    table.add_column("Budget")
+    table.add_column("Weight", justify="right")
+    table.add_column("Limit", justify="right")
+    for page, key, value, limit in over:
+        table.add_row(page, weight_columns[key], str(value), str(limit))
+    get_console().print(table)
+    error(f"{len({page for page, _, _, _ in over})} pages are over budget")
+
+
+def build(data, hashes, dependencies, dirty=None, removed=()):
+    """Build the site into the output directory and record its manifest.
+    If `dirty` is given, only those outputs are rebuilt"""
+    if (
+        dirty is not None and not data["_fingerprint"]
+        and os.path.exists(os.path.join(data["_output_dir"], fingerprint_file))
+    ):
+        error("Output directory was built with --fingerprint, build with it again")
+    previous = load_manifest(data["_output_dir"]) if dirty is not None else None
+    variants = (previous or {}).get("variants", {})
+    with profiled("remove_outputs"):
+        remove_outputs(
+            data["_output_dir"], removed, image_settings(data["_globals"]), variants)
+    budgets = budget_settings(data["_globals"])
+    weigh = budgets is not None or data["_weights"] is not None
+    if dirty is not None:
+        all_pages = {
+            shard for shards in page_outputs(data).values() for shard in shards
+        }
+        # weigh every page this build owns the first time weights are asked for
+        if weigh and "weights" not in (previous or {}):
+            dirty = dirty | (all_pages & dependencies.keys())
+        pages = dirty & all_pages
+        assets = dirty & data["assets"].keys()
+        public_files = dirty - pages - assets
+        message(f"Rebuilding {len(dirty)} of {len(dependencies)} files")
+    else:
+        public_files = pages = assets = None
+    rendered = pages
+    # process public
+    if data["public"] and public_files != set():
+        with profiled("process_public"):
+            process_public(
+                os.path.join(data["_input_dir"], "public"),
+                data["_output_dir"],
+                public_files,
+                data["_hardlink"],
+            )
+    if data["_stream"]:
+        # pages are written and minified as they are rendered
+        with profiled("stream_pages"):
+            stats = stream_pages(data, pages, weigh)
+        made, weights = stats["variants"], stats["weights"]
+        if dirty is None:
+            public_files = set(list_public_files(data))
+        pages = assets = set()
+    else:
+        made, weights = {}, {}
+        # process pages
+        with profiled("process_pages"):
+            process_pages(data, pages, data["_jobs"])
+        # write files
+        with profiled("write_files"):
+            write_files(data)
+        with profiled("write_assets"):
+            write_assets(data, assets)
+    search_files = []
+    if dirty is None or data["search"] or removed:
+        with profiled("write_search_index"):
+            search_files = write_search_index(
+                data, None if dirty is None else all_pages - dirty)
+    # minify
+    with profiled("minify"):
+        stats = minify(
+            data["_output_dir"],
+            public_files | pages | assets if public_files is not None else None,
+            data["_jobs"],
+            data["_cache_dir"],
+            image_settings(data["_globals"]),
+            weigh,
+        )
+    made.update(stats["variants"])
+    weights.update(stats["weights"])
+    # variants the image settings no longer make
+    stale = {
+        path for file, paths in made.items()
+        for path in variants.get(file, []) if path not in paths
+    }
+    if stale:
+        remove_outputs(data["_output_dir"], stale)
+    variants = {
+        file: paths for file, paths in variants.items() if file in dependencies
+    } | made
+    fingerprinted = []
+    if data["_fingerprint"]:
+        with profiled("fingerprint"):
+            fingerprinted = fingerprint(
+                data["_output_dir"],
+                public_files,
+                rendered,
+                set(removed) | stale,
+                data["assets"].keys(),
+                image_settings(data["_globals"]),
+            )
+    # gzip sidecars of the outputs compressed by the previous build
+    compressed = (previous or {}).get("compressed")
+    if data["_gzip"] is not None:
+        with profiled("gzip_outputs"):
+            compressed = gzip_outputs(
+                data["_output_dir"],
+                data["_gzip"],
+                # compress everything the first time sidecars are asked for
+                dirty | set(search_files) | set(fingerprinted)
+                if compressed is not None else None,
+                data["_jobs"],
+                {
+                    file: content_hash for file, content_hash in compressed.items()
+                    if file not in removed
+                } if compressed is not None else None,
+            )
+    elif compressed:
+        # sidecars of a build without --gzip would go stale
+        remove_sidecars(data["_output_dir"], compressed)
+        compressed = None
+    if weigh:
+        # pages not minified again keep the weights of the previous build
+        weights = {
+            page: weight for page, weight in (previous or {}).get("weights", {}).items()
+            if page in dependencies
+        } | weights
+    with profiled("save_manifest"):
+        save_manifest(
+            data["_output_dir"], hashes, dependencies, compressed, data["_input_stats"],
+            data["_shard"], weights if weigh else None, variants)
+    # files a shard's pages reference may be in other shards, merging checks them
+    if weigh and not data["_shard"]:
+        with profiled("check_weights"):
+            check_weights(data["_output_dir"], weights, budgets, data["_weights"])
+
+
+def copy_data(data):
+    """Copy data so that processing leaves the parsed trees intact"""
+    new_data = dict(data)
+    new_data["pages"] = dict(data["pages"])
+    new_data["templates"] = dict(data["templates"])
+    new_data["search"] = dict(data["search"])
+    return new_data
+
+
+def snapshot(input_dir):
+    """Returns modification time and size of every input file"""
+    files = {}
+    for file in input_files(input_dir):
+        try:
+            stat = os.stat(os.path.join(input_dir, file))
+        except FileNotFoundError:
+            continue
+        files[file] = (stat.st_mtime_ns, stat.st_size)
+    return files
+
+
+def update_data(data, hashes, changed):
+    """Re-read changed input files into data and hashes. Returns the files
+    whose contents actually changed, or all of them if hashes is None"""
+    input_dir = data["_input_dir"]
+    modified = set()
+    # config.yml first, pages are parsed with its notebook settings
+    for file in sorted(changed, key=lambda file: file != "config.yml"):
+        file_path = os.path.join(input_dir, file)
+        exists = os.path.isfile(file_path)
+        if hashes is not None:
+            new_hash = hash_file(file_path) if exists else None
+            if new_hash == hashes.get(file):
+                continue
+            if exists:
+                hashes[file] = new_hash
+            else:
+                del hashes[file]
+        modified.add(file)
+        directory = file.replace("\\", "/").split("/")[0]
+        name = leftover_path(directory, file)
+        if file == "config.yml":
+            settings = notebook_settings(data["_globals"])
+            data["_globals"] = load_config(input_dir)
+            if notebook_settings(data["_globals"]) != settings:
+                # notebook images are extracted with the new inline limit
+                for page in [page for page in data["pages"] if page.endswith(".ipynb")]:
+                    forget_assets(data["assets"], page)
+                    data["pages"][page] = get_file_tree(
+                        os.path.join(input_dir, "pages", page), page, data["assets"],
+                        notebook_settings(data["_globals"]))
+        elif directory == "pages":
+            forget_assets(data["assets"], name)
+            if exists:
+                data["pages"][name] = get_file_tree(
+                    file_path, name, data["assets"], notebook_settings(data["_globals"]))
+            else:
+                data["pages"].pop(name, None)
+        elif directory == "templates":
+            data.setdefault("templates", {})
+            if exists:
+                data["templates"][name] = get_file_tree(file_path)
+            else:
+                data["templates"].pop(name, None)
+        elif directory == "public":
+            data["public"] = os.path.isdir(os.path.join(input_dir, "public"))
+    return modified
+
+
+def watch(data, hashes, dependencies, interval=0.5, debounce=0.3):
+    """Poll the input directory and rebuild only the outputs affected by
+    each change. Changes arriving within `debounce` seconds of each other
+    are rebuilt together"""
+    message("Watching for changes, press Ctrl+C to stop...")
+    previous = snapshot(data["_input_dir"])
+    try:
+        while True:
+            time.sleep(interval)
+            current = snapshot(data["_input_dir"])
+            if current == previous:
+                continue
+            # wait for the burst of saves to settle
+            while True:
+                time.sleep(debounce)
+                settled = snapshot(data["_input_dir"])
+                if settled == current:
+                    break
+                current = settled
+            changed = {
+                file for file in previous.keys() | current.keys()
+                if previous.get(file) != current.get(file)
+            }
+            previous = current
+            data["_input_stats"] = current
+            changed = update_data(data, hashes, changed)
+            if not changed:
+                continue
+            message(f"Changed: {', '.join(sorted(changed))}")
+            new_dependencies = get_dependencies(data)
+            dirty = affected_outputs(changed, new_dependencies)
+            removed = dependencies.keys() - new_dependencies.keys()
+            dependencies = new_dependencies
+            try:
+                build(copy_data(data), hashes, dependencies, dirty, removed)
+            except SystemExit:
+                message("Build failed, waiting for changes...")
+    except KeyboardInterrupt:
+        message("Stopped watching")
+
+
+def render_page(data, page):
+    """Render a single output page and return its contents"""
+    page_data = copy_data(data)
+    process_pages(page_data, {page})
+    return page_data["pages"][page]
+
+
+def serve(data, port, minify_output=False, interval=0.5):
+    """Serve the website straight from memory. Pages are rendered when first
+    requested and cached until one of their inputs changes, public files are
+    read from the input directory"""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    input_dir = data["_input_dir"]
+    public_dir = os.path.abspath(os.path.join(input_dir, "public"))
+    lock = threading.Lock()
+    rendered = {}
+    state = {
+        "snapshot": snapshot(input_dir),
+        "checked": time.monotonic(),
+        "dependencies": get_dependencies(data),
+        "pages": {
+            shard for shards in page_outputs(data).values() for shard in shards
+        },
+    }
+
+    def refresh():
+        if time.monotonic() - state["checked"] < interval:
+            return
+        current = snapshot(input_dir)
+        state["checked"] = time.monotonic()
+        previous = state["snapshot"]
+        if current == previous:
+            return
+        state["snapshot"] = current
+        changed = update_data(data, None, {
+            file for file in previous.keys() | current.keys()
+            if previous.get(file) != current.get(file)
+        })
+        state["dependencies"] = get_dependencies(data)
+        state["pages"] = {
+            shard for shards in page_outputs(data).values() for shard in shards
+        }
+        for page in affected_outputs(changed, state["dependencies"]):
+            rendered.pop(page, None)
+        for page in rendered.keys() - state["pages"]:
+            del rendered[page]
+
+    def resolve(url):
+        path = urllib.parse.unquote(urllib.parse.urlsplit(url).path).lstrip("/")
+        if not path or path.endswith("/"):
+            path += "index.html"
+        path = os.path.normpath(path)
+        if path.startswith(".."):
+            return None, None
+        for candidate in (path, path + ".html"):
+            if candidate in state["pages"] or candidate in data["assets"]:
+                return candidate, None
+        file_path = os.path.join(public_dir, path)
+        if os.path.isfile(file_path):
+            return path, file_path
+        return None, None
+
+    def page_contents(page):
+        if page in data["assets"]:
+            contents = data["assets"][page]["contents"]
+            return minify_bytes(page, contents) if minify_output else contents
+        if page not in rendered:
+            message(f"Rendering: {page}")
+            contents = render_page(data, page).encode("utf-8")
+            if minify_output:
+                contents = minify_bytes(page, contents)
+            rendered[page] = contents
+        return rendered[page]
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            status = 200
+            try:
+                with lock:
+                    refresh()
+                    path, file_path = resolve(self.path)
+                    if path is None and "404.html" in state["pages"]:
+                        path, status = "404.html", 404
+                    if path is not None and file_path is None:
+                        contents = page_contents(path)
+                if path is None:
+                    self.send_error(404)
+                    return
+                if file_path is not None:
+                    with open(file_path, "rb") as f:
+                        contents = f.read()
+                    if minify_output:
+                        contents = minify_bytes(path, contents)
+            except SystemExit:
+                self.send_error(500, "Error rendering page, see the console")
+                return
+            content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(contents)))
+            self.end_headers()
+            self.wfile.write(contents)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    message(f"Serving on http://127.0.0.1:{port}, press Ctrl+C to stop...")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        message("Stopped serving")
+    finally:
+        server.server_close()
+
+
+def in_shard(file, shard):
+    """Whether an output belongs to shard (index, count), decided by the hash
+    of its name so that every machine splits the outputs the same way"""
+    index, count = shard
+    key = hashlib.sha256(file.replace(os.sep, "/").encode("utf-8")).digest()
+    return int.from_bytes(key[:8], "big") % count == index - 1
+
+
+def select_shard(data, dependencies, shard):
+    """Returns the dependencies of the outputs in the shard. Notebook images
+    go with the first page using them, which writes them in streaming builds"""
+    selected = {}
+    for file, deps in dependencies.items():
+        key = file
+        if file in data["assets"]:
+            key = output_name(min(data["assets"][file]["pages"]))
+        if in_shard(key, shard):
+            selected[file] = deps
+    return selected
+
+
+def build_outputs(data, hashes, dependencies, manifest):
+    """Build everything, the shard of data if sharding, or only what changed
+    since `manifest` if given"""
+    if data["_shard"]:
+        dependencies = select_shard(data, dependencies, data["_shard"])
+        message(f"Building shard {data['_shard'][0]} of {data['_shard'][1]}")
+    if manifest:
+        with profiled("changed_outputs"):
+            dirty, removed = changed_outputs(manifest, hashes, dependencies)
+        build(data, hashes, dependencies, dirty, removed)
+    elif data["_shard"]:
+        build(data, hashes, dependencies, set(dependencies))
+    else:
+        build(data, hashes, dependencies)
+
+
+def merge(args):
+    """Combine the outputs of shard builds into the output directory, making
+    sure they were built from the same inputs and that together they are the
+    whole site, and finish it with what needs all the pages: the search
+    index and fingerprinting"""
+    message(f"Merging {len(args.merge)} shards...")
+    globals = load_config(args.inputdir)
+    manifests = []
+    for shard_dir in args.merge:
+        manifest = load_manifest(shard_dir)
+        if manifest is None or "shard" not in manifest:
+            error(f"'{shard_dir}' is not the output of a --shard build")
+        manifests.append(manifest)
+    count = manifests[0]["shard"][1]
+    indexes = sorted(manifest["shard"][0] for manifest in manifests)
+    if any(manifest["shard"][1] != count for manifest in manifests):
+        error("Shards were split in different numbers of shards")
+    if len(set(indexes)) != len(indexes):
+        error("The same shard was given more than once")
+    if indexes != list(range(1, count + 1)):
+        missing = sorted(set(range(1, count + 1)) - set(indexes))
+        error(f"Missing shards {', '.join(f'{i}/{count}' for i in missing)}")
+    inputs = manifests[0]["inputs"]
+    for shard_dir, manifest in zip(args.merge, manifests):
+        if manifest["inputs"] != inputs:
+            different = sorted(
+                file for file in inputs.keys() | manifest["inputs"].keys()
+                if inputs.get(file) != manifest["inputs"].get(file)
+            )
+            error(f"'{shard_dir}' was built from different inputs: {', '.join(different[:10])}")
+    outputs = {}
+    compressed = {}
+    weights = {}
+    variants = {}
+    for manifest in manifests:
+        for file, deps in manifest["outputs"].items():
+            if file in outputs:
+                error(f"'{file}' was built by more than one shard")
+            outputs[file] = deps
+        compressed.update(manifest.get("compressed", {}))
+        weights.update(manifest.get("weights", {}))
+        variants.update(manifest.get("variants", {}))
+
+    # copy the shards, files in more than one of them have to be the same
+    settings = search_settings(globals)
+    search_dir = settings["dir"] + "/" if settings else None
+    origins = {}
+    for shard_dir in args.merge:
+        for root, _, names in os.walk(shard_dir):
+            for name in names:
+                source = os.path.join(root, name)
+                file = leftover_path(shard_dir, source).replace(os.sep, "/")
+                if file == manifest_file or (search_dir and file.startswith(search_dir)):
+                    continue
+                # sidecars of pages about to be rewritten would go stale
+                if args.fingerprint and file.endswith(".gz"):
+                    continue
+                destination = os.path.join(args.outputdir, file)
+                if file in origins:
+                    with open(source, "rb") as a, open(destination, "rb") as b:
+                        if a.read() != b.read():
+                            error(f"'{file}' differs between '{origins[file]}' and '{shard_dir}'")
+                    continue
+                origins[file] = shard_dir
+                os.makedirs(os.path.dirname(destination), exist_ok=True)
+                copy_file(source, destination, args.hardlink)
+
+    written = []
+    if settings:
+        entries = {}
+        for shard_dir in args.merge:
+            entries.update(load_search_index(shard_dir, settings, None))
+        written += write_search_index(
+            {"_globals": globals, "_output_dir": args.outputdir, "search": entries})
+    if args.fingerprint:
+        compressed = None
+        # notebook images are already named after their contents
+        assets = {
+            file for file, deps in outputs.items()
+            if not file.endswith(".html") and any(dep.endswith(".ipynb") for dep in deps)
+            and all(dep.endswith(".ipynb") or dep == "config.yml" for dep in deps)
+        }
+        written += fingerprint(args.outputdir, None, None, (), assets, image_settings(globals))
+    if args.gzip:
+        compressed = gzip_outputs(
+            args.outputdir, args.gzip_min_size, None, args.jobs, compressed)
+    elif compressed and written:
+        # the shards' sidecars of files merging wrote again are stale
+        for file in written:
+            if file in compressed:
+                remove_sidecars(args.outputdir, [file])
+                del compressed[file]
+    budgets = budget_settings(globals)
+    weigh = budgets is not None or args.weights is not None
+    save_manifest(
+        args.outputdir, inputs, outputs, compressed or None,
+        weights=weights if weigh else None, variants=variants)
+    message(f"Merged {count} shards into {args.outputdir}: {len(outputs)} outputs")
+    if weigh:
+        check_weights(args.outputdir, weights, budgets, args.weights)
+
+
+def configure(data, args):
+    """Apply the build options given on the command line to data"""
+    data["_output_dir"] = args.outputdir
+    data["_jobs"] = args.jobs
+    data["_hardlink"] = args.hardlink
+    data["_fingerprint"] = args.fingerprint
+    data["_weights"] = args.weights
+    data["_shard"] = args.shard
+    data["_gzip"] = args.gzip_min_size if args.gzip else None
+    data["_cache_dir"] = None
+    if not args.nocache:
+        data["_cache_dir"] = args.cachedir or os.path.join(args.inputdir, ".sssg-cache")
+
+
+def daemon_socket(input_dir):
+    """Path of the socket the daemon of an input directory listens on"""
+    import tempfile
+
+    key = hashlib.sha256(os.path.abspath(input_dir).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(tempfile.gettempdir(), f"sssg-{key}.sock")
+
+
+def daemon_build(state, request):
+    """Run a build sent by a client with the daemon's warm data, printing on
+    the current console. Raises SystemExit like a build on its own would"""
+    os.chdir(request["cwd"])
+    get_console().print("[bold cyan]Simple SSG[/bold cyan]")
+    args = parse_arguments(request["args"])
+    if os.path.abspath(args.inputdir) != state["input_dir"]:
+        error(f"This daemon builds {state['input_dir']}")
+    init_profiling(args.profile is not None)
+    try:
+        current = snapshot(state["input_dir"])
+        if state["data"] is None:
+            with profiled("generate_data"):
+                state["data"] = generate_data(state["input_dir"], None)
+            with profiled("hash_inputs"):
+                state["hashes"] = hash_inputs(state["input_dir"], current)
+        else:
+            previous = state["stats"]
+            changed = {
+                file for file in previous.keys() | current.keys()
+                if previous.get(file) != current.get(file)
+            }
+            # a failed update leaves data half read, start over next time
+            data, state["data"] = state["data"], None
+            with profiled("update_data"):
+                update_data(data, state["hashes"], changed)
+            state["data"] = data
+        state["stats"] = current
+        data = copy_data(state["data"])
+        configure(data, args)
+        data["_input_stats"] = current
+        hashes = dict(state["hashes"])
+        manifest = load_manifest(args.outputdir) if args.incremental else None
+        with profiled("get_dependencies"):
+            dependencies = get_dependencies(data)
+        build_outputs(data, hashes, dependencies, manifest)
+    finally:
+        # failed builds are profiled too
+        if args.profile:
+            write_profile(args.profile)
+        init_profiling(False)
+
+
+def daemon(args):
+    """Keep the parsed site, the libraries and the markdown converters warm
+    and build the site whenever a client asks, streaming the build's output
+    back. Builds run one at a time, each with its own options"""
+    global console
+    from rich.console import Console
+    from rich.theme import Theme
+
+    if not hasattr(socket, "AF_UNIX"):
+        error("The daemon needs Unix domain sockets, which this platform does not have")
+    input_dir = os.path.abspath(args.inputdir)
+    path = daemon_socket(input_dir)
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except OSError:
+            # left over by a daemon that did not stop cleanly
+            os.remove(path)
+        else:
+            error(f"A daemon is already running for {args.inputdir}")
+        finally:
+            probe.close()
+    state = {"input_dir": input_dir, "data": None, "hashes": None, "stats": None}
+    # parse and hash the site and load the libraries before the first build,
+    # the pool workers of every build are forked with them loaded too
+    state["data"] = generate_data(input_dir, None)
+    state["stats"] = snapshot(input_dir)
+    state["hashes"] = hash_inputs(input_dir, state["stats"])
+    import importlib
+
+    for module in ("yaml", "minify_html_onepass", "PIL.Image", "concurrent.futures"):
+        importlib.import_module(module)
+    for text in ("warm\n", "```\nwarm\n```\n"):
+        convert_markdown("", text)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0o177)
+    try:
+        server.bind(path)
+    finally:
+        os.umask(umask)
+    server.listen()
+    message(f"Daemon for {args.inputdir} listening on {path}, press Ctrl+C to stop...")
+    own_console = get_console()
+    cwd = os.getcwd()
+    try:
+        while True:
+            connection, _ = server.accept()
+            with (
+                connection,
+                connection.makefile("r", encoding="utf-8") as reader,
+                connection.makefile("w", encoding="utf-8") as writer,
             ):
-                pic = Image.open(file_path)
-                # remove metadata
-                stripped = Image.new(pic.mode, pic.size)
-                stripped.putdata(pic.getdata())
-                if 'P' in pic.mode:
-                    stripped.putpalette(pic.getpalette())  # type: ignore
-                stripped.save(file_path, optimized=True, quality=95)
+                request = json.loads(reader.readline())
+                console = Console(
+                    theme=Theme(inherit=False),
+                    file=writer,
+                    force_terminal=request["terminal"],
+                    width=request["width"],
+                )
+                status = 0
+                try:
+                    daemon_build(state, request)
+                except SystemExit as e:
+                    status = e.code if isinstance(e.code, int) else 1
+                except Exception as e:
+                    console.print(f"[red]> Build failed: {e!r}[/red]")
+                    status = 1
+                finally:
+                    console = own_console
+                    os.chdir(cwd)
+                try:
+                    writer.write(f"\0{status}\n")
+                    writer.flush()
+                except OSError:
+                    pass
+                message(f"Built for {request['cwd']}, exit status {status}")
+    except KeyboardInterrupt:
+        message("Stopped daemon")
+    finally:
+        server.close()
+        os.remove(path)
+
+
+def client(args, argv):
+    """Send a build to the daemon of the input directory and print its
+    output as it comes. Returns the exit status of the build"""
+    path = daemon_socket(args.inputdir)
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(path)
+    except OSError:
+        error(f"No daemon is running for {args.inputdir}, start one with --daemon")
+    request = {
+        "args": argv,
+        "cwd": os.getcwd(),
+        "terminal": sys.stdout.isatty(),
+        "width": shutil.get_terminal_size().columns,
+    }
+    with connection:
+        connection.sendall((json.dumps(request) + "\n").encode("utf-8"))
+        out = sys.stdout.buffer
+        status = None
+        while chunk := connection.recv(65536):
+            if status is not None:
+                status += chunk
+                continue
+            end = chunk.find(b"\0")
+            out.write(chunk if end == -1 else chunk[:end])
+            out.flush()
+            if end != -1:
+                status = chunk[end + 1:]
+    if status is None:
+        error("The daemon stopped before the build finished")
+    return int(status.strip() or 1)
 
 
 def run():
     """Run the app"""
-    console.print("[bold cyan]Simple SSG[/bold cyan]")
     args = parse_arguments()
-    data = generate_data(args.inputdir, args.outputdir)
-    # process public
-    if data["public"]:
-        process_public(os.path.join(
-            data["_input_dir"], "public"), data["_output_dir"])
-    # process pages
-    process_pages(data)
-    # write files
-    write_files(data)
-    # minify
-    minify(data["_output_dir"])
+    if args.client:
+        sys.exit(client(args, sys.argv[1:]))
+    get_console().print("[bold cyan]Simple SSG[/bold cyan]")
+    if args.daemon:
+        daemon(args)
+        return
+    if args.merge:
+        merge(args)
+        return
+    init_profiling(args.profile is not None)
+    try:
+        with profiled("generate_data"):
+            data = generate_data(args.inputdir, args.outputdir, args.stream)
+        configure(data, args)
+        if args.serve:
+            serve(data, args.port, args.minify)
+            return
+        manifest = load_manifest(data["_output_dir"]) if args.incremental else None
+        with profiled("hash_inputs"):
+            data["_input_stats"] = snapshot(data["_input_dir"])
+            hashes = hash_inputs(data["_input_dir"], data["_input_stats"], manifest)
+        with profiled("get_dependencies"):
+            dependencies = get_dependencies(data)
+        # processing mutates the trees, keep the parsed ones around for watching
+        build_data = copy_data(data) if args.watch else data
+        build_outputs(build_data, hashes, dependencies, manifest)
+    finally:
+        # failed builds, like ones over budget, are profiled too. Only the
+        # first build is, rebuilds while watching are not
+        if args.profile:
+            write_profile(args.profile)
+            init_profiling(False)
+    if args.watch:
+        watch(data, hashes, dependencies)
 
 
 if __name__ == "__main__":